@@ -6,13 +6,18 @@ import random
 from datetime import datetime, timedelta
 import configparser
 import os
+import uuid
 import matplotlib.pyplot as plt
 import scipy as sp
 import local_statistics as local_stat
 import data_exchange
+import instrumentation
+import sequential_testing
+import bootstrap
+import cuped
 
 
-def save_experiment_results(engine, experiment_id, metric_name, control_val, variant_val, p_val, alpha, sample_a, sample_b, duration):
+def save_experiment_results(engine, experiment_id, metric_name, control_val, variant_val, p_val, alpha, sample_a, sample_b, duration, notes=None):
     lift = (variant_val - control_val) / control_val if control_val != 0 else 0
     
     # Clean up previous results for this metric/experiment to avoid duplicates
@@ -32,22 +37,121 @@ def save_experiment_results(engine, experiment_id, metric_name, control_val, var
         'sample_size_a': sample_a,
         'sample_size_b': sample_b,
         'test_duration_days': duration,
-        'notes': f"Alpha: {alpha}"
+        'notes': notes or f"Alpha: {alpha}"
     }])
     results_df.to_sql('ExperimentMetrics', con=engine, if_exists='append', index=False)
     print(f"Saved {metric_name} results to ExperimentMetrics.")
 
-if __name__ == "__main__":
+def save_sequential_results(engine, experiment_id, accumulator, alpha):
+    """Saves the current look of a streaming SequentialAccumulator as CR_mSPRT and ARPU_mSPRT metrics"""
+    for metric_name, result in accumulator.results().items():
+        if result['p_value'] < alpha:
+            print(f"\n{metric_name} mSPRT: significant difference, the experiment can be stopped. Always-valid P-value {result['p_value']:.4}.")
+        else:
+            print(f"\n{metric_name} mSPRT: no significant difference yet. Always-valid P-value {result['p_value']:.4}.")
+        save_experiment_results(engine, experiment_id, f"{metric_name}_mSPRT",
+                                result['control_value'],
+                                result['variant_value'],
+                                result['p_value'], alpha,
+                                result['sample_size_a'],
+                                result['sample_size_b'],
+                                accumulator.duration_days(),
+                                notes=f"Alpha: {alpha}; always-valid mSPRT p-value after {accumulator.num_events} events")
+
+def build_segment_cells(segment_stats, control='A', variant='B'):
+    """Turns local_engine segment statistics into CR and ARPU cells for local_statistics.batch_test_cells"""
+    keys = ['experiment_id', 'segment', 'segment_value']
+    stats = segment_stats.assign(conversion_rate=segment_stats['purchase_count'] / segment_stats['checkout_count'])
+    stats = stats.pivot_table(index=keys, columns='test_group',
+                              values=['checkout_count', 'conversion_rate', 'view_count', 'arpu', 'revenue_var'])
+    stats.columns = [f"{value}_{group}" for value, group in stats.columns]
+    stats = stats.reset_index()
+    name = stats['segment'] + '=' + stats['segment_value'].astype(str)
+    cr_cells = pd.DataFrame({
+        'experiment_id': stats['experiment_id'], 'metric_name': 'CR|' + name, 'metric_type': 'proportion',
+        'control_value': stats[f'conversion_rate_{control}'], 'variant_value': stats[f'conversion_rate_{variant}'],
+        'sample_size_a': stats[f'checkout_count_{control}'], 'sample_size_b': stats[f'checkout_count_{variant}'],
+        'var_a': np.nan, 'var_b': np.nan})
+    arpu_cells = pd.DataFrame({
+        'experiment_id': stats['experiment_id'], 'metric_name': 'ARPU|' + name, 'metric_type': 'mean',
+        'control_value': stats[f'arpu_{control}'], 'variant_value': stats[f'arpu_{variant}'],
+        'sample_size_a': stats[f'view_count_{control}'], 'sample_size_b': stats[f'view_count_{variant}'],
+        'var_a': stats[f'revenue_var_{control}'], 'var_b': stats[f'revenue_var_{variant}']})
+    return pd.concat([cr_cells, arpu_cells], ignore_index=True).dropna(subset=['sample_size_a', 'sample_size_b'])
+
+def save_experiment_results_bulk(engine, results, alpha, duration):
+    """Upserts all tested cells into ExperimentMetrics with one MERGE keyed by experiment_id and metric_name"""
+    results_df = pd.DataFrame({
+        'experiment_id': results['experiment_id'].astype(int),
+        'metric_name': results['metric_name'],
+        'control_value': results['control_value'],
+        'variant_value': results['variant_value'],
+        'lift': results['lift'],
+        'p_value': results['p_value'],
+        'is_significant': results['is_significant'],
+        'analysis_date': datetime.now(),
+        'sample_size_a': results['sample_size_a'].astype(int),
+        'sample_size_b': results['sample_size_b'].astype(int),
+        'test_duration_days': duration,
+        'notes': [f"Alpha: {alpha}; adjusted P-value: {p:.4}" for p in results['p_value_adjusted']]
+    })
+    staging_table = f"ExperimentMetricsStaging_{uuid.uuid4().hex[:8]}"
+    columns = list(results_df.columns)
+    with engine.begin() as conn:
+        results_df.to_sql(staging_table, con=conn, index=False)
+        conn.execute(text(f"""
+            MERGE ExperimentMetrics AS t
+            USING {staging_table} AS s
+            ON t.experiment_id = s.experiment_id AND t.metric_name = s.metric_name
+            WHEN MATCHED THEN UPDATE SET {', '.join(f't.{c} = s.{c}' for c in columns[2:])}
+            WHEN NOT MATCHED THEN INSERT ({', '.join(columns)}) VALUES ({', '.join(f's.{c}' for c in columns)});
+        """))
+        conn.execute(text(f"DROP TABLE {staging_table}"))
+    print(f"Saved {len(results_df)} segment results to ExperimentMetrics.")
+
+def bootstrap_notes(config, values_a, values_b, alpha, counts_a=None, counts_b=None):
+    """Runs the Poisson bootstrap for the lift and formats its intervals for the notes column"""
+    num_replicates = int(config.get('ANALYSIS', 'BOOTSTRAP_REPLICATES', fallback='2000'))
+    if num_replicates == 0:
+        return None
+    ci = bootstrap.poisson_bootstrap_lift(values_a, values_b, num_replicates, alpha=alpha,
+                                          max_workers=int(config.get('ANALYSIS', 'BOOTSTRAP_WORKERS', fallback='0')) or None,
+                                          time_budget=float(config.get('ANALYSIS', 'BOOTSTRAP_TIME_BUDGET', fallback='60')),
+                                          counts_a=counts_a, counts_b=counts_b)
+    print(f"Lift {ci['rel_lift']:.2%}, {1-alpha:.0%} CI [{ci['rel_lift_ci'][0]:.2%}, {ci['rel_lift_ci'][1]:.2%}] "
+          f"from {ci['num_replicates']} Poisson bootstrap replicates")
+    return (f"Alpha: {alpha}; abs lift CI [{ci['abs_lift_ci'][0]:.4}, {ci['abs_lift_ci'][1]:.4}]; "
+            f"rel lift CI [{ci['rel_lift_ci'][0]:.4}, {ci['rel_lift_ci'][1]:.4}]; {ci['num_replicates']} replicates")
+
+def save_cuped_results(engine, config, experiment_id, start_date, end_date, alpha, duration):
+    """Tests CR and ARPU with CUPED, pre-period revenue and conversion of the history window as covariates"""
+    history_start = datetime.strptime(config['DATA']['HISTORY_START_DATE'], "%d-%m-%Y").strftime("%Y-%m-%d")
+    history_end = datetime.strptime(config['DATA']['HISTORY_END_DATE'], "%d-%m-%Y").strftime("%Y-%m-%d")
+    history_revenue = data_exchange.get_total_revenue_by_user(engine, config, history_start, history_end)
+    user_funnel = data_exchange.get_user_funnel(engine, config, start_date, end_date)
+    for metric_name, result in cuped.cuped_metrics(user_funnel, history_revenue).items():
+        print(f"\n{metric_name} CUPED: theta {result['theta']:.4}, variance reduced by {result['variance_reduction']:.1%}, "
+              f"P-value {result['p_value']:.4}.")
+        save_experiment_results(engine, experiment_id, f"{metric_name}_CUPED",
+                                result['control_value'],
+                                result['variant_value'],
+                                result['p_value'], alpha,
+                                result['sample_size_a'],
+                                result['sample_size_b'],
+                                duration,
+                                notes=f"Alpha: {alpha}; theta: {result['theta']:.4}; variance reduction: {result['variance_reduction']:.4}")
+
+def run(config, engine, experiment_id=None):
+    """Tests the experiment (the latest one if None) and saves the results to ExperimentResults"""
 
-    config, engine = data_exchange.connect_to_db()
-    
     # Get experiment info
-    sql_str_for_experiment_id = "SELECT MAX([experiment_id]) FROM [dbo].[Experiments]"
-    try:
-        experiment_id = int(pd.read_sql(sql_str_for_experiment_id, con=engine).iloc[0,0])
-    except:
-        experiment_id = 1
-        print("Warning: Could not fetch experiment_id, defaulting to 1")
+    if experiment_id is None:
+        sql_str_for_experiment_id = "SELECT MAX([experiment_id]) FROM [dbo].[Experiments]"
+        try:
+            experiment_id = int(pd.read_sql(sql_str_for_experiment_id, con=engine).iloc[0,0])
+        except:
+            experiment_id = 1
+            print("Warning: Could not fetch experiment_id, defaulting to 1")
 
     test_start = datetime.strptime(config['DATA']['TEST_START_DATE'], "%d-%m-%Y")
     test_end = datetime.strptime(config['DATA']['TEST_END_DATE'], "%d-%m-%Y")
@@ -57,8 +161,7 @@ if __name__ == "__main__":
     # A/B test for CR = Unique number of users with purchase / Unique number of users with checkout
     start_date = test_start.strftime("%Y-%m-%d")
     end_date = test_end.strftime("%Y-%m-%d")
-    sql_str = f"SELECT * FROM dbo.GetBasicStatByGroup('{start_date}', '{end_date}')"
-    group_cr = pd.read_sql(sql_str, con=engine)
+    group_cr = data_exchange.get_basic_stat_by_group(engine, config, start_date, end_date)
     group_cr = group_cr.set_index('test_group')
     
     p_value = local_stat.proportions_z_test(
@@ -72,6 +175,10 @@ if __name__ == "__main__":
     else:
         print(f"\nA/B test doesn't pass! \nNull-hypothesis can NOT be rejected as P-value for CR test {p_value:.4}. \nSamples A and B from experiment do not represent significantly difference.")
 
+    # Per-user purchase indicators of checkout users are fully defined by the counts
+    cr_values = [np.repeat([1.0, 0.0], [group_cr.loc[g]['purchase_count'], group_cr.loc[g]['checkout_count'] - group_cr.loc[g]['purchase_count']])
+                 for g in ['A', 'B']]
+    cr_notes = bootstrap_notes(config, cr_values[0], cr_values[1], alpha)
     
     save_experiment_results(engine, experiment_id, 'CR', 
                             group_cr.loc['A']['conversion_rate'], 
@@ -79,15 +186,17 @@ if __name__ == "__main__":
                             p_value, alpha, 
                             group_cr.loc['A']['view_count'], 
                             group_cr.loc['B']['view_count'], 
-                            duration_days)
+                            duration_days,
+                            notes=cr_notes)
     
     
     # A/B test for revenue
-    sql_str = f"SELECT * FROM dbo.GetTotalRevenueByUser('{start_date}', '{end_date}')"
-    group_revenue = pd.read_sql(sql_str, con=engine)
-    group_a_values = group_revenue[group_revenue['test_group'] == 'A']['revenue_sum']
-    group_b_values = group_revenue[group_revenue['test_group'] == 'B']['revenue_sum']
-    u_stat, p_value = sp.stats.mannwhitneyu(group_a_values, group_b_values, alternative='two-sided')
+    # Number of users by revenue value: users without purchases are a single zero row
+    revenue_hist = data_exchange.get_revenue_histogram_by_group(engine, config, start_date, end_date)
+    hist_a = revenue_hist[revenue_hist['test_group'] == 'A']
+    hist_b = revenue_hist[revenue_hist['test_group'] == 'B']
+    u_stat, p_value = local_stat.mannwhitneyu_compressed(hist_a['revenue_sum'], hist_a['num_users'],
+                                                         hist_b['revenue_sum'], hist_b['num_users'], alternative='two-sided')
     
     if p_value < alpha:
         print(f"\nA/B test for revenue passed. \nCan reject null-hypothesis as P-value for ARPU test {p_value:.2}. \nSamples A and B on history data represent significantly difference.")
@@ -96,12 +205,36 @@ if __name__ == "__main__":
     
     
     save_experiment_results(engine, experiment_id, 'ARPU', 
-                            group_a_values.mean(), 
-                            group_b_values.mean(), 
+                            np.average(hist_a['revenue_sum'], weights=hist_a['num_users']), 
+                            np.average(hist_b['revenue_sum'], weights=hist_b['num_users']), 
                             p_value, alpha, 
-                            len(group_a_values), 
-                            len(group_b_values), 
-                            duration_days)
-    
-    
-        
\ No newline at end of file
+                            hist_a['num_users'].sum(), 
+                            hist_b['num_users'].sum(), 
+                            duration_days,
+                            notes=bootstrap_notes(config, hist_a['revenue_sum'], hist_b['revenue_sum'], alpha,
+                                                  hist_a['num_users'], hist_b['num_users']))
+
+    # Variance-adjusted CR and ARPU with the pre-period of every user as covariate
+    if config.getboolean('CUPED', 'ENABLED', fallback=False):
+        save_cuped_results(engine, config, experiment_id, start_date, end_date, alpha, duration_days)
+
+    # Continuous monitoring: state is updated while events are loaded, EventLogs is not queried
+    state_path = config.get('SEQUENTIAL', 'STATE_PATH', fallback='.//data//sequential_state.pkl')
+    if config.getboolean('SEQUENTIAL', 'ENABLED', fallback=False) and os.path.exists(state_path):
+        accumulator = sequential_testing.SequentialAccumulator.load(state_path)
+        save_sequential_results(engine, experiment_id, accumulator, alpha)
+        accumulator.save(state_path)
+
+    # Every metric against every slice: device, day and new vs returning users
+    if config.getboolean('ANALYSIS', 'SEGMENTS', fallback=False) and data_exchange.use_local_engine(config):
+        import local_engine
+        segment_stats = local_engine.segment_stats(data_exchange.snapshot_dir(config), start_date, end_date)
+        segment_results = local_stat.batch_test_cells(build_segment_cells(segment_stats), alpha,
+                                                      config.get('ANALYSIS', 'CORRECTION', fallback='holm'))
+        print(f"\n{segment_results['is_significant'].sum()} of {len(segment_results)} segment cells are significant.")
+        save_experiment_results_bulk(engine, segment_results, alpha, duration_days)
+
+if __name__ == "__main__":
+    config, engine = data_exchange.connect_to_db()
+    with instrumentation.span('analyse'):
+        run(config, engine)
@@ -0,0 +1,68 @@
+import pandas as pd
+import numpy as np
+import hashlib
+from datetime import datetime
+from functools import lru_cache
+import scipy as sp
+import local_statistics as local_stat
+
+# Buckets per experiment, weights are resolved to 1/10000 of traffic
+NUM_BUCKETS = 10_000
+
+@lru_cache(maxsize=None)
+def _hash_key(experiment_id, salt):
+    """16-character SipHash key derived from the experiment, so each experiment gets an independent split"""
+    return hashlib.md5(f"{salt}:{experiment_id}".encode()).hexdigest()[:16]
+
+@lru_cache(maxsize=None)
+def _bucket_bounds(weights):
+    weights = np.asarray(weights, dtype=float)
+    return np.round(np.cumsum(weights) / weights.sum() * NUM_BUCKETS).astype(np.int64)
+
+def user_buckets(user_ids, experiment_id, salt=''):
+    """Stable bucket in [0, NUM_BUCKETS) for each user id.
+    Unlike the built-in hash() it does not change between processes.
+    """
+    user_ids = np.asarray(user_ids, dtype=object).astype(str).astype(object)
+    hashes = pd.util.hash_array(user_ids, hash_key=_hash_key(experiment_id, salt), categorize=False)
+    return (hashes % np.uint64(NUM_BUCKETS)).astype(np.int64)
+
+def assign_variants(user_ids, experiment_id, variants=('A', 'B'), weights=(0.5, 0.5), salt='')->np.ndarray:
+    """Assigns a batch of users to variants with the given traffic weights.
+
+    Args:
+        user_ids: Array-like of user ids.
+        experiment_id (int): Experiment, part of the hash key.
+        variants (tuple): Variant labels, e.g. ('A', 'B').
+        weights (tuple): Traffic share per variant, normalized to sum 1.
+        salt (str): Extra salt to re-randomize an experiment.
+
+    Returns: array of variant labels.
+    """
+    bounds = _bucket_bounds(tuple(weights))
+    variant_idx = np.searchsorted(bounds, user_buckets(user_ids, experiment_id, salt), side='right')
+    return np.asarray(variants)[variant_idx]
+
+def assign_variant(user_id, experiment_id, variants=('A', 'B'), weights=(0.5, 0.5), salt='')->str:
+    """Single-user lookup for the serving tier, gives the same result as assign_variants"""
+    return str(assign_variants([user_id], experiment_id, variants, weights, salt)[0])
+
+def build_assignments(user_ids, experiment_id, variants=('A', 'B'), weights=(0.5, 0.5), salt='', assigned_at=None)->pd.DataFrame:
+    """Returns assignments with the UserAssignments table schema"""
+    return pd.DataFrame({
+        'user_id': user_ids,
+        'experiment_id': experiment_id,
+        'test_group': assign_variants(user_ids, experiment_id, variants, weights, salt),
+        'assigned_at': assigned_at or datetime.today()
+    })
+
+def check_assignment_srm(test_groups, variants=('A', 'B'), weights=(0.5, 0.5)):
+    """SRM p-value of the observed split against the configured weights.
+    For two variants it is the same test as local_statistics.check_srm.
+    """
+    counts = pd.Series(test_groups).value_counts().reindex(variants, fill_value=0).to_numpy()
+    ratios = np.asarray(weights, dtype=float) / np.sum(weights)
+    if len(variants) == 2:
+        return local_stat.check_srm(counts[0], counts[1], expected_ratio_a=ratios[0])
+    chi2_stat, p_value = sp.stats.chisquare(f_obs=counts, f_exp=counts.sum() * ratios)
+    return p_value
@@ -0,0 +1,200 @@
+import pandas as pd
+import numpy as np
+import argparse
+import configparser
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+import assignment
+import bulk_loader
+import collect_experiment_data
+import data_exchange
+import generate_ecomm_data
+import local_statistics as local_stat
+import metrics_cube
+import sqlite_standin
+
+# Same periods as the sample config: three history months and the test month
+HISTORY_START, HISTORY_END = datetime(2025, 3, 1), datetime(2025, 5, 31)
+TEST_START, TEST_END = datetime(2025, 6, 1), datetime(2025, 6, 30)
+
+STAGES = ['generate', 'load', 'cube', 'populate_daily_metrics', 'basic_stat', 'revenue_histogram', 'mannwhitneyu', 'plots']
+
+class PeakRSS:
+    """Peak resident set size of the process while the block runs, sampled from /proc/self/statm.
+    Where /proc is missing the process-wide ru_maxrss is reported.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+
+    def _current(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._current())
+
+    def __enter__(self):
+        self.start = self.peak = self._current()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._current())
+
+def seeded_user_ids(num_users, seed):
+    """UUID-formatted user ids drawn from the seed"""
+    digits = np.random.default_rng(seed).integers(0, 16, size=(num_users, 32), dtype=np.uint8)
+    chars = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)[digits]
+    chars = np.insert(chars, [8, 12, 16, 20], ord('-'), axis=1)
+    return np.ascontiguousarray(chars).view('S36').ravel().astype(str).astype(object)
+
+def event_chunks(users, seed, chunk_size):
+    return generate_ecomm_data.generate_event_chunks(users, HISTORY_START, HISTORY_END, TEST_START, TEST_END,
+                                                     chunk_size=chunk_size, seed=seed)
+
+def run_size(num_users, db_dir, seed=42, chunk_size=1_000_000, stages=STAGES):
+    """Runs the stages on a fresh stand-in database with num_users users.
+    Returns a list of {num_users, stage, seconds, rows, peak_rss_mb, rss_growth_mb}: memory not returned by
+    earlier stages stays in peak_rss_mb, rss_growth_mb is the peak above the RSS at the start of the stage.
+    """
+    db_path = os.path.join(db_dir, f"bench_{num_users}.db")
+    assets_dir = os.path.join(db_dir, f"assets_{num_users}")
+    for path in [db_path, assets_dir]:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    os.makedirs(assets_dir)
+    engine = sqlite_standin.create_standin_engine(db_path)
+    sqlite_standin.create_schema(engine)
+    config = configparser.ConfigParser()
+    config.read_dict({'ANALYSIS': {'ENGINE': 'sql'}})
+    start_date, end_date = TEST_START.strftime("%Y-%m-%d"), TEST_END.strftime("%Y-%m-%d")
+
+    pd.DataFrame([['benchmark', 'H0', 'running']], columns=['experiment_name', 'hypothesis', 'status']).to_sql(
+        'Experiments', con=engine, if_exists='append', index=False)
+    users = assignment.build_assignments(seeded_user_ids(num_users, seed), 1)
+    bulk_loader.load_chunks(engine, 'UserAssignments', [users], max_workers=1)
+    state = {}
+
+    def generate():
+        return sum(len(df) for df in event_chunks(users, seed, chunk_size))
+    def load():
+        return bulk_loader.load_chunks(engine, 'EventLogs', event_chunks(users, seed, chunk_size))['rows']
+    def cube():
+        state['cube'] = metrics_cube.build_from_engine(engine, 1, chunk_size)
+        return int(state['cube'].event_count.sum())
+    def populate():
+        collect_experiment_data.populate_daily_metrics(engine, 1, state['cube'])
+        return int(pd.read_sql("SELECT COUNT(*) FROM DailyMetrics", con=engine).iloc[0, 0])
+    def basic_stat():
+        return len(data_exchange.get_basic_stat_by_group(engine, config, start_date, end_date))
+    def revenue_histogram():
+        state['hist'] = data_exchange.get_revenue_histogram_by_group(engine, config, start_date, end_date)
+        return len(state['hist'])
+    def mannwhitneyu():
+        hist_a = state['hist'][state['hist']['test_group'] == 'A']
+        hist_b = state['hist'][state['hist']['test_group'] == 'B']
+        local_stat.mannwhitneyu_compressed(hist_a['revenue_sum'], hist_a['num_users'],
+                                           hist_b['revenue_sum'], hist_b['num_users'])
+        return int(state['hist']['num_users'].sum())
+    def plots():
+        collect_experiment_data.visualize_daily_metrics(engine, config, state['cube'], start_date, end_date, assets_dir)
+        return len(os.listdir(assets_dir))
+
+    stage_functions = {'generate': generate, 'load': load, 'cube': cube, 'populate_daily_metrics': populate,
+                       'basic_stat': basic_stat, 'revenue_histogram': revenue_histogram,
+                       'mannwhitneyu': mannwhitneyu, 'plots': plots}
+    # Stages read what the earlier ones produced
+    needed = {'populate_daily_metrics': ['cube'], 'plots': ['cube'], 'mannwhitneyu': ['revenue_histogram']}
+    to_run = set(stages) | {dep for stage in stages for dep in needed.get(stage, [])}
+    if to_run - {'generate'}:
+        to_run.add('load')
+
+    results = []
+    for stage in STAGES:
+        if stage not in to_run:
+            continue
+        with PeakRSS() as rss:
+            start = time.perf_counter()
+            rows = stage_functions[stage]()
+            seconds = time.perf_counter() - start
+        print(f"[{num_users} users] {stage}: {seconds:.2f}s, {rows} rows, "
+              f"peak RSS {rss.peak / 2**20:.0f} MB (+{(rss.peak - rss.start) / 2**20:.0f} MB)")
+        if stage in stages:
+            results.append({'num_users': num_users, 'stage': stage, 'seconds': seconds, 'rows': rows,
+                            'peak_rss_mb': rss.peak / 2**20, 'rss_growth_mb': (rss.peak - rss.start) / 2**20})
+    engine.dispose()
+    return results
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'sqlite': sqlite3.sqlite_version, 'pandas': pd.__version__, 'numpy': np.__version__,
+            'timestamp': datetime.now().isoformat(timespec='seconds')}
+
+def compare(results, baseline, tolerance=0.25, min_seconds=0.05, min_mb=32)->pd.DataFrame:
+    """Joins results to the baseline by (num_users, stage).
+    A stage regresses when it is more than tolerance slower or needs more than tolerance more memory
+    (rss_growth_mb). Differences below min_seconds and min_mb are noise and never regressions.
+    """
+    keys = ['num_users', 'stage']
+    columns = keys + ['seconds', 'rss_growth_mb']
+    df = pd.DataFrame(results)[columns].merge(pd.DataFrame(baseline['results'])[columns], on=keys, how='left',
+                                              suffixes=('', '_baseline'))
+    df['time_ratio'] = df['seconds'] / df['seconds_baseline']
+    df['rss_ratio'] = df['rss_growth_mb'] / df['rss_growth_mb_baseline']
+    slower = (df['time_ratio'] > 1 + tolerance) & (df['seconds'] - df['seconds_baseline'] > min_seconds)
+    larger = (df['rss_ratio'] > 1 + tolerance) & (df['rss_growth_mb'] - df['rss_growth_mb_baseline'] > min_mb)
+    df['regression'] = slower | larger
+    return df
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the pipeline stages on seeded SQLite stand-in databases")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help="numbers of users, e.g. 10000 100000 1000000 10000000")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--chunk-size', type=int, default=1_000_000)
+    parser.add_argument('--db-dir', default='.//data//benchmark', help="directory of the stand-in databases")
+    parser.add_argument('--output', default='.//data//benchmark//results.json')
+    parser.add_argument('--baseline', help="results JSON to compare with, the exit code is 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative slowdown or RSS growth")
+    args = parser.parse_args()
+
+    os.makedirs(args.db_dir, exist_ok=True)
+    results = []
+    for num_users in args.sizes:
+        results += run_size(num_users, args.db_dir, args.seed, args.chunk_size, args.stages)
+    report = {'environment': environment(), 'seed': args.seed, 'results': results}
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            comparison = compare(results, json.load(f), args.tolerance)
+        print(comparison.round(3).to_string(index=False))
+        regressions = comparison[comparison['regression']]
+        if not regressions.empty:
+            print(f"\n{len(regressions)} stages regressed against {args.baseline}:")
+            print(regressions[['num_users', 'stage', 'seconds', 'seconds_baseline', 'rss_growth_mb', 'rss_growth_mb_baseline']]
+                  .round(3).to_string(index=False))
+            raise SystemExit(1)
+        print("\nNo regressions against the baseline.")
@@ -0,0 +1,91 @@
+import numpy as np
+import os
+import time
+import itertools
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# Per-worker data, set once by the pool initializer instead of pickling it with every block
+_groups = None
+
+def _init_worker(groups):
+    global _groups
+    _groups = groups
+
+def compress_values(values, counts=None):
+    """Splits values into (non-zero values, number of zeros). Zeros only add to the weight sum.
+    With counts, values are distinct values and counts the number of users with each of them.
+    """
+    values = np.asarray(values, dtype=float)
+    counts = np.ones(len(values), dtype=np.int64) if counts is None else np.asarray(counts)
+    is_zero = values == 0
+    return np.repeat(values[~is_zero], counts[~is_zero]), int(counts[is_zero].sum())
+
+def _replicate_block(num_replicates, seed, max_cells=2_000_000):
+    """Weighted means of both groups for a block of Poisson(1) bootstrap replicates.
+    Users are streamed in chunks, so memory stays at max_cells weights whatever the number of users.
+    """
+    rng = np.random.default_rng(seed)
+    means = []
+    for nonzero, num_zeros in _groups:
+        sums = np.zeros(num_replicates)
+        # Sum of num_zeros independent Poisson(1) weights is Poisson(num_zeros)
+        weights_sum = rng.poisson(num_zeros, size=num_replicates).astype(float)
+        user_chunk = max(1, max_cells // num_replicates)
+        for start in range(0, len(nonzero), user_chunk):
+            x = nonzero[start:start + user_chunk]
+            w = rng.poisson(1.0, size=(num_replicates, len(x))).astype(np.float32)
+            sums += w @ x
+            weights_sum += w.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means.append(sums / weights_sum)
+    return means[0], means[1]
+
+def poisson_bootstrap_lift(values_a, values_b, num_replicates=2000, block_size=100, alpha=0.05,
+                           max_workers=None, time_budget=None, seed=42, counts_a=None, counts_b=None):
+    """Poisson bootstrap confidence intervals for the lift of group B mean over group A mean.
+
+    Args:
+        values_a, values_b: Per-user values, e.g. revenue_sum or 0/1 conversion indicators.
+        num_replicates (int): Number of bootstrap replicates.
+        block_size (int): Replicates computed together in one vectorized block.
+        alpha (float): 1 - confidence level of the intervals.
+        max_workers (int): Processes in the pool, all cores if None.
+        time_budget (float): Seconds after which no new blocks are started, the intervals
+            are computed from the replicates finished by then.
+        seed (int): Seed of the replicate blocks.
+        counts_a, counts_b: Optional number of users per value, when values are distinct values.
+
+    Returns: dict with abs_lift, rel_lift, their (low, high) intervals and num_replicates used.
+    """
+    groups = [compress_values(values_a, counts_a), compress_values(values_b, counts_b)]
+    num_blocks = int(np.ceil(num_replicates / block_size))
+    seeds = np.random.SeedSequence(seed).spawn(num_blocks)
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    means_a, means_b = [], []
+    max_workers = max_workers or os.cpu_count()
+    blocks = iter([(min(block_size, num_replicates - i * block_size), s) for i, s in enumerate(seeds)])
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(groups,)) as executor:
+        # Only max_workers blocks are in flight, so the budget is overrun by one block at most
+        pending = {executor.submit(_replicate_block, *block) for block in itertools.islice(blocks, max_workers)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                block_a, block_b = future.result()
+                means_a.append(block_a)
+                means_b.append(block_b)
+            if deadline is None or time.monotonic() < deadline:
+                pending |= {executor.submit(_replicate_block, *block) for block in itertools.islice(blocks, len(done))}
+    means_a, means_b = np.concatenate(means_a), np.concatenate(means_b)
+    abs_lift = means_b - means_a
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_lift = abs_lift / means_a
+    mean_a = np.average(values_a, weights=counts_a)
+    mean_b = np.average(values_b, weights=counts_b)
+    quantiles = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    return {
+        'abs_lift': mean_b - mean_a,
+        'abs_lift_ci': tuple(np.nanpercentile(abs_lift, quantiles)),
+        'rel_lift': (mean_b - mean_a) / mean_a if mean_a != 0 else np.nan,
+        'rel_lift_ci': tuple(np.nanpercentile(rel_lift, quantiles)),
+        'num_replicates': len(abs_lift)
+    }
@@ -0,0 +1,125 @@
+import pandas as pd
+import numpy as np
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Loader name -> function(engine, table, df, **options) writing one chunk
+LOADERS = {}
+
+def register_loader(name):
+    """Decorator which registers a chunk loader under the given name"""
+    def decorator(func):
+        LOADERS[name] = func
+        return func
+    return decorator
+
+def default_method(engine):
+    """Picks the bulk path for the engine dialect"""
+    return {'sqlite': 'sqlite', 'duckdb': 'duckdb'}.get(engine.dialect.name, 'executemany')
+
+def _to_records(df):
+    """Converts a chunk to a list of tuples with NULLs as None and timestamps as ISO strings"""
+    columns = []
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            values = values.dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+        values = values.astype(object).where(values.notna(), None)
+        columns.append(values.to_numpy())
+    return list(zip(*columns))
+
+@register_loader('executemany')
+def load_executemany(engine, table, df, batch_size=50_000):
+    """Default path for MSSQL: pyodbc fast_executemany is set on the engine by data_exchange.connect_to_db"""
+    df.to_sql(table, con=engine, if_exists='append', index=False, chunksize=batch_size)
+
+@register_loader('bcp')
+def load_bcp(engine, table, df, staging_dir=None, bcp_path='bcp'):
+    """Stages the chunk as a delimited file and loads it with the bcp utility"""
+    url = engine.url
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', dir=staging_dir, delete=False, newline='') as f:
+        df.to_csv(f, sep='\t', header=False, index=False, date_format='%Y-%m-%d %H:%M:%S')
+        staged_path = f.name
+    try:
+        subprocess.run([bcp_path, f"{url.database}.dbo.{table}", 'in', staged_path,
+                        '-S', url.host, '-U', url.username, '-P', url.password,
+                        '-c', '-t', '\\t', '-b', str(len(df))],
+                       check=True, capture_output=True)
+    finally:
+        os.remove(staged_path)
+
+@register_loader('parquet')
+def load_parquet(engine, table, df, staging_dir='.//staging'):
+    """Stages the chunk as a Parquet file for an external bulk import (OPENROWSET, COPY INTO, DuckDB)"""
+    table_dir = os.path.join(staging_dir, table)
+    os.makedirs(table_dir, exist_ok=True)
+    df.to_parquet(os.path.join(table_dir, f"part-{time.time_ns()}-{threading.get_ident()}.parquet"), index=False)
+
+# SQLite allows a single writer, the lock keeps chunk preparation parallel but inserts serialized
+_sqlite_lock = threading.Lock()
+
+@register_loader('sqlite')
+def load_sqlite(engine, table, df):
+    """Local SQLite stand-in: one executemany over the raw sqlite3 connection per chunk"""
+    records = _to_records(df)
+    columns = ', '.join(f'"{col}"' for col in df.columns)
+    placeholders = ', '.join('?' for _ in df.columns)
+    with _sqlite_lock:
+        conn = engine.raw_connection()
+        try:
+            conn.cursor().executemany(f'INSERT INTO "{table}" ({columns}) VALUES ({placeholders})', records)
+            conn.commit()
+        finally:
+            conn.close()
+
+@register_loader('duckdb')
+def load_duckdb(engine, table, df):
+    """Local DuckDB stand-in: the chunk is registered as a view and appended with one INSERT ... SELECT"""
+    import duckdb
+    with duckdb.connect(engine.url.database) as conn:
+        conn.register('chunk_df', df)
+        conn.execute(f'INSERT INTO "{table}" ({", ".join(df.columns)}) SELECT * FROM chunk_df')
+
+def load_chunks(engine, table, chunks, method=None, if_exists='append', max_workers=4, **options):
+    """Writes chunks of DataFrames to table while they are being produced.
+
+    Args:
+        engine: SQLAlchemy engine.
+        table (str): Target table name.
+        chunks: Iterable of DataFrames with the same columns.
+        method (str): Name of a registered loader, picked by dialect if None.
+        if_exists (str): 'append' or 'replace'. With 'replace' the table is re-created from the first chunk.
+        max_workers (int): Number of chunks loaded in parallel.
+
+    Returns: dict with rows, seconds and rows_per_sec.
+    """
+    method = method or default_method(engine)
+    loader = LOADERS[method]
+    start = time.perf_counter()
+    rows = 0
+    pending = set()
+
+    def load(df):
+        loader(engine, table, df, **options)
+        return len(df)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i, df in enumerate(chunks):
+            if i == 0 and if_exists == 'replace':
+                df.head(0).to_sql(table, con=engine, if_exists='replace', index=False)
+            # Bounded queue: the producer waits when max_workers chunks are in flight
+            if len(pending) >= max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rows += future.result()
+            pending.add(executor.submit(load, df))
+        for future in pending:
+            rows += future.result()
+    seconds = time.perf_counter() - start
+    stats = {'rows': rows, 'seconds': seconds, 'rows_per_sec': rows / seconds if seconds > 0 else np.nan}
+    print(f"Loaded {rows} rows into {table} with '{method}' in {seconds:.1f}s ({stats['rows_per_sec']:.0f} rows/sec)")
+    return stats
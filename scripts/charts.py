@@ -0,0 +1,100 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+
+# Figures are drawn on their own Figure objects instead of pyplot global state,
+# so several charts (and several experiments) can be rendered at the same time.
+
+COLORS = {'A': '#1F3A5F', 'B': '#C2410C'}
+HASHES_FILE = 'chart_hashes.json'
+
+def daily_pivot(daily, groups=('A', 'B'), event_types=('view', 'add_to_basket', 'checkout', 'purchase'))->pd.DataFrame:
+    """One pivot of the cube daily rows: date x (metric, event_type, test_group) with every column present"""
+    pivot = daily.pivot_table(index='date', columns=['event_type', 'test_group'],
+                              values=['event_count', 'total_revenue', 'unique_users'], aggfunc='sum', fill_value=0)
+    columns = pd.MultiIndex.from_product([['event_count', 'total_revenue', 'unique_users'], list(event_types), list(groups)])
+    return pivot.reindex(columns=columns, fill_value=0)
+
+def daily_charts(daily)->list:
+    """(kind, data, title, ylabel, filename) of the daily plots"""
+    pivot = daily_pivot(daily)
+    cr = (pivot['unique_users']['purchase'] / pivot['unique_users']['checkout'].replace(0, np.nan)).fillna(0)
+    return [
+        ('bar', pivot['event_count']['view'], 'Daily Views', 'Count', 'count_views.png'),
+        ('bar', pivot['event_count']['add_to_basket'], 'Daily Add to Basket', 'Count', 'count_baskets.png'),
+        ('bar', pivot['event_count']['checkout'], 'Daily Checkouts', 'Count', 'count_checkouts.png'),
+        ('bar', pivot['event_count']['purchase'], 'Daily Purchases', 'Count', 'count_purchase.png'),
+        ('bar', pivot['total_revenue']['purchase'], 'Daily Revenue', 'Revenue ($)', 'revenue.png'),
+        ('bar', cr, 'Daily Conversion Rate', 'Conversion Rate', 'daily_cr.png'),
+        ('line', cr, 'Daily Conversion Rate', 'Conversion Rate', 'daily_cr_line.png'),
+    ]
+
+def plot_bar(ax, df):
+    x = np.arange(len(df.index))
+    width = 0.35
+    ax.bar(x - width/2, df['A'], width, label='Group A', color=COLORS['A'])
+    ax.bar(x + width/2, df['B'], width, label='Group B', color=COLORS['B'])
+
+def plot_line(ax, df):
+    x = np.arange(len(df.index))
+    ax.plot(x, df['A'], label='Group A', color=COLORS['A'])
+    ax.plot(x, df['B'], label='Group B', color=COLORS['B'])
+
+def plot_histogram(ax, df):
+    """df is GetRevenueHistogramByGroup: every revenue value is weighted by its number of users"""
+    ax.hist(df['revenue_sum'], bins=20, weights=df['num_users'], color='#94A3B8')
+
+def render(chart, path):
+    kind, df, title, ylabel, _ = chart
+    fig = Figure()
+    ax = fig.subplots()
+    if kind == 'histogram':
+        plot_histogram(ax, df)
+        ax.set_xlabel('Revenue by user($)')
+    else:
+        if kind == 'bar':
+            plot_bar(ax, df)
+        else:
+            plot_line(ax, df)
+        x = np.arange(len(df.index))
+        ax.set_xticks(x[::5], [d.strftime('%m-%d') for d in df.index[::5]])
+        ax.set_xlabel('Date')
+        ax.legend()
+    ax.set_title(title)
+    ax.set_ylabel(ylabel)
+    fig.tight_layout()
+    fig.savefig(path)
+    return path
+
+def chart_hash(chart)->str:
+    kind, df, title, ylabel, filename = chart
+    data = pd.util.hash_pandas_object(df.reset_index(), index=False).to_numpy().tobytes()
+    return hashlib.sha1(data + '|'.join([kind, title, ylabel, filename]).encode()).hexdigest()
+
+def render_charts(charts, assets_dir='.//assets', max_workers=None):
+    """Renders the charts into assets_dir in a process pool.
+    A chart whose data hash is the same as at the last render and whose file exists is skipped.
+    Returns the number of rendered charts.
+    """
+    hashes_path = os.path.join(assets_dir, HASHES_FILE)
+    hashes = {}
+    if os.path.exists(hashes_path):
+        with open(hashes_path) as f:
+            hashes = json.load(f)
+    new_hashes = {chart[4]: chart_hash(chart) for chart in charts}
+    stale = [chart for chart in charts
+             if hashes.get(chart[4]) != new_hashes[chart[4]] or not os.path.exists(os.path.join(assets_dir, chart[4]))]
+    if len(stale) > 1 and max_workers != 1:
+        with ProcessPoolExecutor(max_workers=min(max_workers or len(stale), len(stale))) as executor:
+            list(executor.map(render, stale, [os.path.join(assets_dir, chart[4]) for chart in stale]))
+    else:
+        for chart in stale:
+            render(chart, os.path.join(assets_dir, chart[4]))
+    hashes.update(new_hashes)
+    with open(hashes_path, 'w') as f:
+        json.dump(hashes, f, indent=1)
+    return len(stale)
@@ -1,89 +1,33 @@
 import pandas as pd
 import numpy as np
 from sqlalchemy import create_engine, text
-import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
 import configparser
+import os
 import scipy as sp
 import data_exchange
+import instrumentation
+import bulk_loader
+import metrics_cube
+import daily_sketches
+import charts
 
     
 
-def get_pivoted_df_by_event_type(df, event_name, value_col='event_type', agg_func='sum'):
-    # Filter for the specific event
-    filtered_df = df[df['event_type'] == event_name]
-    
-    pivoted = filtered_df.pivot_table(
-        index='date',
-        columns='test_group',
-        values=value_col, 
-        aggfunc=agg_func,
-        fill_value=0
-    )
-    return pivoted.rename(columns={value_col : 'value'})
-
-def plot_bar(df, title, ylabel, filename):
-    dates = df.index
-    x = np.arange(len(dates))
-    width = 0.35
-    
-    plt.bar(x - width/2, df['A'], width, label='Group A', color='#1F3A5F')
-    plt.bar(x + width/2, df['B'], width, label='Group B', color="#C2410C")
-    
-    plt.title(title)
-    plt.xlabel('Date')
-    plt.ylabel(ylabel)
-    plt.xticks(x[::5], [d.strftime('%m-%d') for d in dates[::5]])
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(filename)
-    plt.close()
-
-def plot_chart(df, title, ylabel, filename):
-    dates = df.index
-    x = np.arange(len(dates))
-    
-    plt.plot(x, df['A'], label='Group A', color='#1F3A5F')
-    plt.plot(x, df['B'], label='Group B', color="#C2410C")
-    
-    plt.title(title)
-    plt.xlabel('Date')
-    plt.ylabel(ylabel)
-    plt.xticks(x[::5], [d.strftime('%m-%d') for d in dates[::5]])
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(filename)
-    plt.close()
-
-def visualize_daily_metrics(engine, start_date, end_date):
-    query = f"SELECT * FROM DailyMetrics WHERE date BETWEEN '{start_date}' AND '{end_date}' ORDER BY date"
-    df = pd.read_sql(query, con=engine)
-    df['date'] = pd.to_datetime(df['date']).dt.date
-
-    df_count_view = get_pivoted_df_by_event_type(df, 'view', value_col='event_count', agg_func='sum')
-    df_count_add_to_basket = get_pivoted_df_by_event_type(df, 'add_to_basket', value_col='event_count', agg_func='sum')
-    df_count_checkout = get_pivoted_df_by_event_type(df, 'checkout', value_col='event_count', agg_func='sum')
-    df_count_purchase = get_pivoted_df_by_event_type(df, 'purchase', value_col='event_count', agg_func='sum')
-    df_value_purchase = get_pivoted_df_by_event_type(df, 'purchase', value_col='total_revenue', agg_func='sum')
-    
-    df_unique_checkout = get_pivoted_df_by_event_type(df, 'checkout', value_col='unique_users', agg_func='sum')
-    df_unique_purchase = get_pivoted_df_by_event_type(df, 'purchase', value_col='unique_users', agg_func='sum')
-    df_cr = df_unique_purchase / df_unique_checkout
-    df_cr = df_cr.fillna(0)
-
-    plot_bar(df_count_view, 'Daily Views', 'Count', './/assets//count_views.png')
-    plot_bar(df_count_add_to_basket, 'Daily Add to Basket', 'Count', './/assets//count_baskets.png')
-    plot_bar(df_count_checkout, 'Daily Checkouts', 'Count', './/assets//count_checkouts.png')
-    plot_bar(df_count_purchase, 'Daily Purchases', 'Count', './/assets//count_purchase.png')
-    plot_bar(df_value_purchase, 'Daily Revenue', 'Revenue ($)', './/assets//revenue.png')
-    plot_bar(df_cr, 'Daily Conversion Rate', 'Conversion Rate', './/assets//daily_cr.png')
-    plot_chart(df_cr, 'Daily Conversion Rate', 'Conversion Rate', './/assets//daily_cr_line.png')
-
-def populate_daily_metrics(engine, experiment_id):
-    with engine.connect() as conn:
-        conn.execute(text(f"DELETE FROM DailyMetrics WHERE experiment_id = {experiment_id}"))
-        conn.execute(text("""
-            INSERT INTO DailyMetrics (date, experiment_id, test_group, event_type, event_count, unique_users, total_revenue, created_at)
+def visualize_daily_metrics(engine, config, cube, start_date, end_date, assets_dir='.//assets'):
+    """Daily plots of the window from the metrics cube and the revenue histogram, rendered in parallel.
+    Charts whose data did not change since the last run are not redrawn.
+    """
+    df = cube.daily(start_date, end_date, by=('test_group', 'event_type'))
+    daily = charts.daily_charts(df)
+    revenue_hist = data_exchange.get_revenue_histogram_by_group(engine, config, start_date, end_date)
+    histogram = ('histogram', revenue_hist, 'Experiment Revenue Distribution', 'Frequency', 'experiment_revenue_histogram.png')
+    num_rendered = charts.render_charts(daily + [histogram], assets_dir,
+                                        int(config.get('ANALYSIS', 'PLOT_WORKERS', fallback='0')) or None)
+    print(f"{num_rendered} of {len(daily) + 1} plots rendered, the others are up to date.")
+
+# Daily aggregates of events since @start_date (NULL for all history) for one experiment
+DAILY_METRICS_SOURCE_SQL = """
             SELECT
                 CAST(e.event_timestamp AS DATE) AS date,
                 u.experiment_id,
@@ -91,75 +35,152 @@ def populate_daily_metrics(engine, experiment_id):
                 e.event_type,
                 COUNT(u.user_id) AS event_count,
                 COUNT(DISTINCT u.user_id) AS unique_users,
-                ISNULL(SUM(e.revenue), 0) AS total_revenue,
-                GETDATE() AS created_at
+                ISNULL(SUM(e.revenue), 0) AS total_revenue
             FROM EventLogs AS e
             JOIN UserAssignments AS u ON e.user_id = u.user_id
             WHERE e.event_timestamp IS NOT NULL
+              AND u.experiment_id = :experiment_id
+              AND (:start_date IS NULL OR e.event_timestamp >= :start_date)
             GROUP BY CAST(e.event_timestamp AS DATE), u.test_group, u.experiment_id, e.event_type
-        """))
-        conn.execute(text(f"DELETE FROM MonthlyCumulativeUniqueUsers WHERE experiment_id = {experiment_id}"))
-        conn.execute(text("""
-                          WITH UserFirstSeenInMonth AS (
-                SELECT 
-                    e.user_id,
-                    a.test_group, 
-                    a.experiment_id,
-                    e.event_type,
-                    MONTH(e.event_timestamp) AS event_month,
-                    MIN(CAST(e.event_timestamp AS DATE)) AS first_seen_date
-                FROM EventLogs AS e
-                LEFT JOIN UserAssignments AS a 
-                ON e.user_id = a.user_id
-                WHERE e.event_timestamp IS NOT NULL
-                GROUP BY e.user_id, MONTH(e.event_timestamp), a.test_group, a.experiment_id, e.event_type
-            )
-            INSERT INTO MonthlyCumulativeUniqueUsers (date, test_group, experiment_id, event_type, cumulative_unique_users)
-            SELECT 
-                first_seen_date AS date,
-                test_group,
-                experiment_id,
-                event_type,
-                SUM(COUNT(user_id)) OVER (PARTITION BY event_month, test_group, experiment_id, event_type ORDER BY first_seen_date) AS cumulative_unique_users
-            FROM UserFirstSeenInMonth
-            GROUP BY first_seen_date, event_month, test_group, experiment_id, event_type
-            """)        )
+"""
+
+def get_watermark(conn, experiment_id):
+    """Returns the last event_timestamp already aggregated for the experiment or None"""
+    return conn.execute(text(
+        "SELECT high_water_mark FROM RefreshWatermarks WHERE experiment_id = :experiment_id AND table_name = 'DailyMetrics'"
+    ), {'experiment_id': experiment_id}).scalar()
+
+def set_watermark(conn, experiment_id, high_water_mark):
+    conn.execute(text("""
+        MERGE RefreshWatermarks AS t
+        USING (SELECT :experiment_id AS experiment_id, 'DailyMetrics' AS table_name) AS s
+        ON t.experiment_id = s.experiment_id AND t.table_name = s.table_name
+        WHEN MATCHED THEN UPDATE SET high_water_mark = :high_water_mark, updated_at = GETDATE()
+        WHEN NOT MATCHED THEN INSERT (experiment_id, table_name, high_water_mark, updated_at)
+            VALUES (:experiment_id, 'DailyMetrics', :high_water_mark, GETDATE());
+    """), {'experiment_id': experiment_id, 'high_water_mark': high_water_mark})
+
+def get_max_event_timestamp(conn, experiment_id, after=None):
+    """Returns (min, max) event_timestamp of the experiment events later than after"""
+    return conn.execute(text("""
+        SELECT MIN(e.event_timestamp), MAX(e.event_timestamp)
+        FROM EventLogs AS e
+        JOIN UserAssignments AS u ON e.user_id = u.user_id
+        WHERE u.experiment_id = :experiment_id
+          AND (:after IS NULL OR e.event_timestamp > :after)
+    """), {'experiment_id': experiment_id, 'after': after}).one()
+
+def populate_daily_metrics(engine, experiment_id, cube, incremental=False):
+    """Refreshes DailyMetrics and MonthlyCumulativeUniqueUsers for the experiment.
+
+    Full mode rebuilds all rows of the experiment. Incremental mode reads the high-water mark
+    of event_timestamp from RefreshWatermarks and recomputes only dates from the day of the
+    first new event, merging them into existing rows. The first incremental run does a full rebuild.
+    Refreshed rows get the users sketch from the metrics cube, cumulative unique users are
+    running unions of the daily sketches instead of a distinct scan of EventLogs.
+    """
+    with engine.connect() as conn:
+        watermark = get_watermark(conn, experiment_id) if incremental else None
+        first_new_ts, last_new_ts = get_max_event_timestamp(conn, experiment_id, after=watermark)
+        if last_new_ts is None:
+            print("DailyMetrics table is up to date.")
+            return
+        params = {'experiment_id': experiment_id, 'start_date': None}
+
+        if watermark is None:
+            conn.execute(text("DELETE FROM DailyMetrics WHERE experiment_id = :experiment_id"), params)
+            conn.execute(text(f"""
+                INSERT INTO DailyMetrics (date, experiment_id, test_group, event_type, event_count, unique_users, total_revenue, created_at)
+                SELECT date, experiment_id, test_group, event_type, event_count, unique_users, total_revenue, GETDATE()
+                FROM ({DAILY_METRICS_SOURCE_SQL}) AS s
+            """), params)
+        else:
+            # Days before the first new event are final, days since then are recomputed and merged
+            params['start_date'] = pd.Timestamp(first_new_ts).date()
+            conn.execute(text(f"""
+                MERGE DailyMetrics AS t
+                USING ({DAILY_METRICS_SOURCE_SQL}) AS s
+                ON t.date = s.date AND t.experiment_id = s.experiment_id 
+                   AND t.test_group = s.test_group AND t.event_type = s.event_type
+                WHEN MATCHED THEN UPDATE SET 
+                    event_count = s.event_count, 
+                    unique_users = s.unique_users, 
+                    total_revenue = s.total_revenue, 
+                    created_at = GETDATE()
+                WHEN NOT MATCHED THEN INSERT (date, experiment_id, test_group, event_type, event_count, unique_users, total_revenue, created_at)
+                    VALUES (s.date, s.experiment_id, s.test_group, s.event_type, s.event_count, s.unique_users, s.total_revenue, GETDATE());
+            """), params)
+        set_watermark(conn, experiment_id, last_new_ts)
         conn.commit()
+
+    # Cumulative counts start on the first day of the month, earlier months are not touched
+    start_date = params['start_date']
+    month_start = None if start_date is None else pd.Timestamp(start_date).replace(day=1)
+    daily = daily_sketches.daily_sketches_from_cube(cube, month_start)
+    refreshed = daily if start_date is None else daily[daily['date'] >= pd.Timestamp(start_date)]
+    daily_sketches.save_daily_sketches(engine, experiment_id, refreshed)
+    daily_sketches.save_cumulative_uniques(engine, experiment_id, daily_sketches.cumulative_uniques(daily), start_date)
+    if start_date is None:
         print("DailyMetrics table populated successfully.")
+    else:
+        print(f"DailyMetrics table refreshed from {start_date}.")
 
 
-def plot_revenue_histogram(engine, start_date, end_date):
-    sql_str = f"SELECT * FROM dbo.GetTotalRevenueByUser('{start_date}', '{end_date}')"
-    df = pd.read_sql(sql_str, con=engine)
+def build_metrics_cube(engine, config, experiment_id):
+    """Builds the date x group x device x event cube of the experiment with one pass over the events and saves it"""
+    if data_exchange.use_local_engine(config):
+        cube = metrics_cube.build_from_snapshot(data_exchange.snapshot_dir(config), experiment_id)
+    else:
+        cube = metrics_cube.build_from_engine(engine, experiment_id, int(config['DATA'].get('CHUNK_SIZE', 1_000_000)))
+    cube.save(config.get('CUBE', 'PATH', fallback=f'.//data//cube_{experiment_id}.npz'))
+    return cube
 
-    
-    # plt.figure(figsize=(10, 6))
-    plt.hist(df['revenue_sum'], bins=20, color='#94A3B8')
-    plt.title('Experiment Revenue Distribution')
-    plt.xlabel('Revenue by user($)')
-    plt.ylabel('Frequency')
-    plt.tight_layout()
-    plt.savefig('.//assets//experiment_revenue_histogram.png')
-    plt.close()
+def save_metrics_cube(engine, cube):
+    """Replaces the MetricsCube rows of the experiment with the daily cube cells and their prefix sums"""
+    df = cube.daily(by=('test_group', 'device', 'event_type'))
+    df.insert(1, 'experiment_id', cube.experiment_id)
+    cells = df.groupby(['test_group', 'device', 'event_type'])
+    df['cumulative_event_count'] = cells['event_count'].cumsum()
+    df['cumulative_revenue'] = cells['total_revenue'].cumsum().round(2)
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM MetricsCube WHERE experiment_id = :experiment_id"), {'experiment_id': cube.experiment_id})
+    bulk_loader.load_chunks(engine, 'MetricsCube', [df], max_workers=1)
+
+def run(config, engine, experiment_id=None, assets_dir='.//assets'):
+    """Refreshes DailyMetrics of the experiment (the latest one if None) and saves its statistics and plots to assets_dir"""
+    os.makedirs(assets_dir, exist_ok=True)
 
-if __name__ == "__main__":
-    config, engine = data_exchange.connect_to_db()
-    
     # Populate DailyMetrics table
-    sql_str_for_experiment_id = "SELECT MAX([experiment_id]) FROM [EcommABtestDB].[dbo].[Experiments]"
-    experiment_id = int(pd.read_sql(sql_str_for_experiment_id, con=engine).iloc[0,0])
-    populate_daily_metrics(engine, experiment_id)
+    if experiment_id is None:
+        sql_str_for_experiment_id = "SELECT MAX([experiment_id]) FROM [EcommABtestDB].[dbo].[Experiments]"
+        experiment_id = int(pd.read_sql(sql_str_for_experiment_id, con=engine).iloc[0,0])
+    if data_exchange.use_local_engine(config):
+        # New events are loaded before collection, the cube and analysis scripts read the refreshed snapshot
+        import local_engine
+        local_engine.snapshot_tables(engine, data_exchange.snapshot_dir(config))
+    # Dashboards and daily plots read the cube, any date window is answered without scanning EventLogs
+    with instrumentation.span('collect.cube'):
+        cube = build_metrics_cube(engine, config, experiment_id)
+        save_metrics_cube(engine, cube)
+    with instrumentation.span('collect.daily_metrics'):
+        populate_daily_metrics(engine, experiment_id, cube, incremental=config['DATA'].get('REFRESH_MODE', 'full') == 'incremental')
     
     # Collect the main experiment statistics 
     # as number of unique users with event, conversion rate, total revenue by group
     start_date = (datetime.strptime(config['DATA']['TEST_START_DATE'], "%d-%m-%Y")).strftime("%Y-%m-%d")
     end_date = datetime.strptime(config['DATA']['TEST_END_DATE'], "%d-%m-%Y").strftime("%Y-%m-%d")
-    sql_str = f"SELECT * FROM dbo.GetBasicStatByGroup('{start_date}', '{end_date}')"
-    experiment_data = pd.read_sql(sql_str, con=engine)
-    experiment_data.to_csv('.//assets//experiment_basic_data.csv', float_format="%.2f",index=False, mode='w')
+    experiment_data = data_exchange.get_basic_stat_by_group(engine, config, start_date, end_date)
+    experiment_data.to_csv(os.path.join(assets_dir, 'experiment_basic_data.csv'), float_format="%.2f",index=False, mode='w')
 
     #Save plots in assets folder
-    visualize_daily_metrics(engine, start_date, end_date)
-    plot_revenue_histogram(engine, start_date, end_date)
-    print("Plots saved successfully.")
-    
\ No newline at end of file
+    with instrumentation.span('collect.plots'):
+        visualize_daily_metrics(engine, config, cube, start_date, end_date, assets_dir)
+
+    cache = data_exchange.get_query_cache(config)
+    if cache is not None:
+        print(f"Query cache: {cache.stats()}")
+
+if __name__ == "__main__":
+    config, engine = data_exchange.connect_to_db()
+    with instrumentation.span('collect'):
+        run(config, engine)
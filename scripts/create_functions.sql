@@ -43,4 +43,45 @@ RETURN
     WHERE EventLogs.event_timestamp BETWEEN @StartDate AND DATEADD(day, 1, @EndDate)
     GROUP BY UserAssignments.test_group, UserAssignments.[user_id]
 );
-GO
\ No newline at end of file
+GO
+
+-- A function to get the number of users by group and total revenue value on time period from @StartDate to @EndDate
+-- Compressed input for the Mann-Whitney test: users without purchases are a single row with revenue_sum = 0
+-- Used in validate_experiment.py, analyse_experiment_data.py
+CREATE FUNCTION dbo.GetRevenueHistogramByGroup (
+    @StartDate DATETIME,
+    @EndDate DATETIME
+)
+RETURNS TABLE
+AS
+RETURN 
+(
+    SELECT test_group
+        , revenue_sum
+        , COUNT(*) AS num_users
+    FROM dbo.GetTotalRevenueByUser(@StartDate, @EndDate)
+    GROUP BY test_group, revenue_sum
+);
+GO
+
+CREATE FUNCTION dbo.GetUserFunnelByUser (
+    @StartDate DATETIME,
+    @EndDate DATETIME
+)
+RETURNS TABLE
+AS
+RETURN 
+(
+    SELECT UserAssignments.test_group
+        , UserAssignments.user_id
+        , MAX(CASE WHEN EventLogs.event_type = 'view' THEN 1 ELSE 0 END) AS has_view
+        , MAX(CASE WHEN EventLogs.event_type = 'checkout' THEN 1 ELSE 0 END) AS has_checkout
+        , MAX(CASE WHEN EventLogs.event_type = 'purchase' THEN 1 ELSE 0 END) AS has_purchase
+        , SUM(ISNULL(EventLogs.revenue, 0)) AS revenue_sum
+    FROM [EcommABtestDB].[dbo].[EventLogs]
+    JOIN [EcommABtestDB].[dbo].[UserAssignments]
+    ON [EventLogs].[user_id] = [UserAssignments].[user_id]
+    WHERE EventLogs.event_timestamp BETWEEN @StartDate AND DATEADD(day, 1, @EndDate)
+    GROUP BY UserAssignments.test_group, UserAssignments.[user_id]
+);
+GO
@@ -57,6 +57,7 @@ CREATE TABLE DailyMetrics (
     event_count INT,
     unique_users INT,
     total_revenue DECIMAL(18, 2), -- NULL for non-purchase events
+    users_sketch VARBINARY(MAX), -- serialized HyperLogLog of the users, see daily_sketches.py
     created_at DATETIME DEFAULT GETDATE(),
     PRIMARY KEY (date, experiment_id, test_group, event_type),
     FOREIGN KEY (experiment_id) REFERENCES Experiments(experiment_id)
@@ -72,4 +73,33 @@ CREATE TABLE MonthlyCumulativeUniqueUsers  (
     PRIMARY KEY (date, experiment_id, test_group, event_type),
     FOREIGN KEY (experiment_id) REFERENCES Experiments(experiment_id)
 );
-GO
\ No newline at end of file
+GO
+
+-- High-water marks of event_timestamp already aggregated, used by incremental refresh
+CREATE TABLE RefreshWatermarks (
+    experiment_id INT,
+    table_name VARCHAR(50), -- 'DailyMetrics'
+    high_water_mark DATETIME,
+    updated_at DATETIME DEFAULT GETDATE(),
+    PRIMARY KEY (experiment_id, table_name),
+    FOREIGN KEY (experiment_id) REFERENCES Experiments(experiment_id)
+);
+GO
+
+-- Daily cube of one experiment by device, written by collect_experiment_data.py from metrics_cube.py.
+-- Cumulative columns are prefix sums over dates: totals of a window are the difference of two rows
+CREATE TABLE MetricsCube (
+    date DATE,
+    experiment_id INT,
+    test_group CHAR(1), -- 'A' or 'B'
+    device VARCHAR(20), -- 'mobile', 'desktop', 'tablet'
+    event_type VARCHAR(50), -- 'view', 'add_to_basket', 'checkout', 'purchase'
+    event_count INT,
+    unique_users INT, -- HyperLogLog estimate
+    total_revenue DECIMAL(18, 2),
+    cumulative_event_count BIGINT,
+    cumulative_revenue DECIMAL(18, 2),
+    PRIMARY KEY (date, experiment_id, test_group, device, event_type),
+    FOREIGN KEY (experiment_id) REFERENCES Experiments(experiment_id)
+);
+GO
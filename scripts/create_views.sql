@@ -34,6 +34,20 @@ CREATE VIEW vw_MonthlyRevenueStats AS
     GROUP BY month;
 GO
 
+-- A view with per-user monthly funnel flags and revenue, the per-user input of vw_MonthlyFunnel and vw_MonthlyRevenueStats
+-- Used in power_simulation.py
+CREATE VIEW vw_MonthlyUserStats AS
+SELECT 
+    MONTH(event_timestamp) AS month,
+    [user_id],
+    MAX(CASE WHEN event_type = 'view' THEN 1 ELSE 0 END) AS has_view,
+    MAX(CASE WHEN event_type = 'checkout' THEN 1 ELSE 0 END) AS has_checkout,
+    MAX(CASE WHEN event_type = 'purchase' THEN 1 ELSE 0 END) AS has_purchase,
+    ISNULL(SUM(CASE WHEN event_type = 'purchase' THEN [revenue] END), 0) AS user_revenue
+FROM EventLogs
+GROUP BY MONTH(event_timestamp), [user_id];
+GO
+
 CREATE VIEW vw_PowerBI_DailyFunnel AS
 SELECT 
     date,
@@ -99,4 +113,23 @@ LEFT JOIN MonthlyCumulativeUniqueUsers
     AND DailyMetrics.event_type = MonthlyCumulativeUniqueUsers.event_type
 WHERE DailyMetrics.date BETWEEN '2025-06-01' AND '2025-06-30'
 GROUP BY DailyMetrics.date, DailyMetrics.experiment_id, DailyMetrics.test_group;
-GO
\ No newline at end of file
+GO
+-- Daily funnel by device from the materialized cube, the date window is set by the report filter
+CREATE VIEW vw_PowerBI_DeviceFunnel AS
+SELECT 
+    date,
+    experiment_id,
+    test_group,
+    device,
+    MAX(CASE WHEN event_type = 'view' THEN unique_users END) AS views,
+    MAX(CASE WHEN event_type = 'add_to_basket' THEN unique_users END) AS baskets,
+    MAX(CASE WHEN event_type = 'checkout' THEN unique_users END) AS checkouts,
+    MAX(CASE WHEN event_type = 'purchase' THEN unique_users END) AS purchases,
+    MAX(CASE WHEN event_type = 'purchase' THEN total_revenue END) AS revenue,
+    MAX(CASE WHEN event_type = 'purchase' THEN cumulative_revenue END) AS cumulative_revenue,
+    MAX(CASE WHEN event_type = 'purchase' THEN cumulative_event_count END) AS cumulative_purchase_events,
+    CAST(MAX(CASE WHEN event_type = 'purchase' THEN unique_users END) AS FLOAT) / 
+        NULLIF(MAX(CASE WHEN event_type = 'checkout' THEN unique_users END), 0) AS conversion_rate
+FROM MetricsCube
+GROUP BY date, experiment_id, test_group, device;
+GO
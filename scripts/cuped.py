@@ -0,0 +1,81 @@
+import pandas as pd
+import numpy as np
+import local_statistics as local_stat
+
+# CUPED: Y_adj = Y - theta * (X - mean(X)) with the pre-period value X of the same user and
+# theta = cov(Y, X) / var(X). Y_adj has the mean of Y and the variance var(Y) * (1 - corr(Y, X)**2),
+# so the sample size needed for the same MDE shrinks by the same factor.
+# theta is pooled over both groups: X is measured before assignment, so the adjustment does not bias the difference.
+
+# Metric -> (users the metric is averaged over, outcome column, covariate column)
+METRICS = {
+    'CR': ('has_checkout', 'has_purchase', 'pre_conversion'),
+    'ARPU': ('has_view', 'revenue_sum', 'pre_revenue'),
+}
+
+def join_covariates(user_funnel, history_revenue)->pd.DataFrame:
+    """Adds pre_revenue and pre_conversion of every user from GetTotalRevenueByUser over the history window.
+    The join is a hash lookup of user ids, users without history events get 0.
+    """
+    history_revenue = history_revenue.dropna(subset=['user_id'])
+    positions = pd.Index(history_revenue['user_id']).get_indexer(user_funnel['user_id'])
+    pre_revenue = np.append(history_revenue['revenue_sum'].to_numpy(dtype=float), 0.0)[positions]
+    return user_funnel.assign(pre_revenue=pre_revenue, pre_conversion=(pre_revenue > 0).astype(float))
+
+def theta(y, x)->float:
+    """Regression coefficient of y on x, 0 if x is constant"""
+    var_x = np.var(x)
+    return float(np.cov(y, x, ddof=0)[0, 1] / var_x) if var_x > 0 else 0.0
+
+def variance_reduction(y, x)->float:
+    """Share of var(y) removed by CUPED with covariate x: corr(y, x)**2"""
+    if len(y) < 2 or np.var(y) == 0 or np.var(x) == 0:
+        return 0.0
+    return float(np.corrcoef(y, x)[0, 1]**2)
+
+def cuped_test(users, outcome, covariate, control='A', variant='B')->dict:
+    """Welch t-test of the CUPED-adjusted outcome between control and variant users"""
+    y = users[outcome].to_numpy(dtype=float)
+    x = users[covariate].to_numpy(dtype=float)
+    t = theta(y, x)
+    adjusted = y - t * (x - x.mean())
+    groups = users['test_group'].to_numpy()
+    stats = [(adjusted[groups == g].mean(), adjusted[groups == g].var(ddof=1), (groups == g).sum()) for g in (control, variant)]
+    _, p_value = local_stat.welch_t_test_batch(*stats[0], *stats[1])
+    return {
+        'theta': t,
+        'variance_reduction': 1 - adjusted.var() / y.var() if y.var() > 0 else 0.0,
+        'control_value': stats[0][0],
+        'variant_value': stats[1][0],
+        'p_value': float(p_value),
+        'sample_size_a': int(stats[0][2]),
+        'sample_size_b': int(stats[1][2]),
+    }
+
+def cuped_metrics(user_funnel, history_revenue, control='A', variant='B')->dict:
+    """CUPED tests of CR and ARPU.
+
+    Args:
+        user_funnel (pd.DataFrame): GetUserFunnelByUser over the test window.
+        history_revenue (pd.DataFrame): GetTotalRevenueByUser over the history window.
+
+    Returns: metric name -> dict with theta, variance_reduction, adjusted control and variant means,
+    p_value and sample sizes.
+    """
+    users = join_covariates(user_funnel, history_revenue)
+    return {metric: cuped_test(users[users[unit] == 1], outcome, covariate, control, variant)
+            for metric, (unit, outcome, covariate) in METRICS.items()}
+
+def history_variance_reduction(df_user_stats, last_month)->dict:
+    """Expected CUPED variance reduction of CR and ARPU estimated on history alone.
+
+    Months before last_month are the pre-period, last_month plays the test window.
+    df_user_stats has the vw_MonthlyUserStats columns.
+    """
+    pre = df_user_stats[df_user_stats['month'] < last_month]
+    pre = pre.groupby('user_id').agg(revenue_sum=('user_revenue', 'sum')).reset_index()
+    post = df_user_stats[df_user_stats['month'] == last_month].rename(columns={'user_revenue': 'revenue_sum'})
+    users = join_covariates(post, pre)
+    return {metric: variance_reduction(users.loc[users[unit] == 1, outcome].to_numpy(dtype=float),
+                                       users.loc[users[unit] == 1, covariate].to_numpy(dtype=float))
+            for metric, (unit, outcome, covariate) in METRICS.items()}
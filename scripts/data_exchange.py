@@ -5,15 +5,165 @@ from sqlalchemy import create_engine
 from datetime import datetime, timedelta
 import configparser
 import os
+import instrumentation
 
-def connect_to_db():
+def connect_to_db(**engine_options):
+    """Reads config.ini and creates the engine. engine_options are passed to create_engine,
+    e.g. pool_size and max_overflow for an engine shared by concurrent pipeline stages.
+    With INSTRUMENTATION.ENABLED every query of the engine is traced, see instrumentation.py.
+    """
     config = configparser.ConfigParser()
     config.read(".//scripts//config.ini")
 
+    # Local SQLite/DuckDB stand-ins can be set with a full SQLAlchemy URL
+    if 'URL' in config['DB PARAMS']:
+        return config, instrumentation.setup(config, create_engine(config['DB PARAMS']['URL'], **engine_options))
+
     #  DB Connection parameters
     connection_string = (
         f"mssql+pyodbc://{config['DB PARAMS']['USERNAME']}:{config['DB PARAMS']['PASSWORT']}@{config['DB PARAMS']['SERVER']}/{config['DB PARAMS']['DATABASE']}"
         f"?driver={config['DB PARAMS']['DRIVER']}"
     )
-    engine = create_engine(connection_string, fast_executemany=True)
-    return config, engine
\ No newline at end of file
+    engine = create_engine(connection_string, fast_executemany=True, **engine_options)
+    return config, instrumentation.setup(config, engine)
+
+def snapshot_dir(config):
+    return config.get('ANALYSIS', 'SNAPSHOT_DIR', fallback='.//data//snapshot')
+
+def use_local_engine(config):
+    """ANALYSIS.ENGINE = local switches the SQL functions to the local columnar snapshot"""
+    return config.get('ANALYSIS', 'ENGINE', fallback='sql') == 'local'
+
+def use_event_store(config):
+    """ANALYSIS.ENGINE = store reads events from the local date-partitioned event store, no database is queried"""
+    return config.get('ANALYSIS', 'ENGINE', fallback='sql') == 'store'
+
+def event_store_dir(config):
+    return config.get('ANALYSIS', 'STORE_DIR', fallback='.//data//event_store')
+
+_query_caches = {}
+
+def get_query_cache(config):
+    """Shared QueryCache from the CACHE section of config.ini or None if caching is disabled"""
+    if not config.getboolean('CACHE', 'ENABLED', fallback=False):
+        return None
+    cache_dir = config.get('CACHE', 'DIR', fallback='.//data//cache')
+    if cache_dir not in _query_caches:
+        import query_cache
+        max_bytes = int(config.get('CACHE', 'MAX_MB', fallback='512')) * 2**20
+        _query_caches[cache_dir] = query_cache.QueryCache(cache_dir, max_bytes)
+    return _query_caches[cache_dir]
+
+def get_data_version(engine, config):
+    """Changes whenever new events or assignments land in the source the results are computed from"""
+    if use_event_store(config):
+        import event_store
+        return event_store.EventStore(event_store_dir(config)).data_version()
+    if use_local_engine(config):
+        stats = [os.stat(os.path.join(snapshot_dir(config), f"{table}.parquet")) for table in ['EventLogs', 'UserAssignments']]
+        return tuple((s.st_mtime_ns, s.st_size) for s in stats)
+    sql_str = """SELECT (SELECT COUNT(*) FROM EventLogs) AS num_events,
+                        (SELECT MAX(event_timestamp) FROM EventLogs) AS last_event_timestamp,
+                        (SELECT COUNT(*) FROM UserAssignments) AS num_assignments"""
+    return tuple(pd.read_sql(sql_str, con=engine).iloc[0])
+
+def _cached(engine, config, query_name, start_date, end_date, compute):
+    if use_local_engine(config):
+        import local_engine
+        local_engine.ensure_snapshot(engine, snapshot_dir(config))
+    cache = get_query_cache(config)
+    if cache is None:
+        return compute()
+    data_version = get_data_version(engine, config)
+    return cache.get_or_compute(query_name, start_date, end_date, data_version, compute)
+
+def get_basic_stat_by_group(engine, config, start_date, end_date):
+    """Result of dbo.GetBasicStatByGroup(start_date, end_date) from the database, the local snapshot or the event store"""
+    def compute():
+        if use_event_store(config):
+            import event_store
+            return event_store.basic_stat_by_group(event_store_dir(config), start_date, end_date)
+        if use_local_engine(config):
+            import local_engine
+            return local_engine.basic_stat_by_group(snapshot_dir(config), start_date, end_date)
+        sql_str = f"SELECT * FROM dbo.GetBasicStatByGroup('{start_date}', '{end_date}')"
+        return pd.read_sql(sql_str, con=engine)
+    return _cached(engine, config, 'GetBasicStatByGroup', start_date, end_date, compute)
+
+def get_total_revenue_by_user(engine, config, start_date, end_date):
+    """Result of dbo.GetTotalRevenueByUser(start_date, end_date) from the database, the local snapshot or the event store"""
+    def compute():
+        if use_event_store(config):
+            import event_store
+            return event_store.total_revenue_by_user(event_store_dir(config), start_date, end_date)
+        if use_local_engine(config):
+            import local_engine
+            return local_engine.total_revenue_by_user(snapshot_dir(config), start_date, end_date)
+        sql_str = f"SELECT * FROM dbo.GetTotalRevenueByUser('{start_date}', '{end_date}')"
+        return pd.read_sql(sql_str, con=engine)
+    return _cached(engine, config, 'GetTotalRevenueByUser', start_date, end_date, compute)
+
+def get_revenue_histogram_by_group(engine, config, start_date, end_date):
+    """Result of dbo.GetRevenueHistogramByGroup(start_date, end_date): number of users by group and revenue value"""
+    def compute():
+        if use_event_store(config):
+            import event_store
+            return event_store.revenue_histogram_by_group(event_store_dir(config), start_date, end_date)
+        if use_local_engine(config):
+            import local_engine
+            return local_engine.revenue_histogram_by_group(snapshot_dir(config), start_date, end_date)
+        sql_str = f"SELECT * FROM dbo.GetRevenueHistogramByGroup('{start_date}', '{end_date}')"
+        df = pd.read_sql(sql_str, con=engine)
+        df['revenue_sum'] = df['revenue_sum'].astype(float)
+        return df
+    return _cached(engine, config, 'GetRevenueHistogramByGroup', start_date, end_date, compute)
+
+def get_user_funnel(engine, config, start_date, end_date):
+    """Result of dbo.GetUserFunnelByUser(start_date, end_date): view, checkout and purchase flags and revenue per user"""
+    def compute():
+        if use_event_store(config):
+            import event_store
+            return event_store.user_funnel(event_store_dir(config), start_date, end_date)
+        if use_local_engine(config):
+            import local_engine
+            return local_engine.user_funnel(snapshot_dir(config), start_date, end_date)
+        sql_str = f"SELECT * FROM dbo.GetUserFunnelByUser('{start_date}', '{end_date}')"
+        df = pd.read_sql(sql_str, con=engine)
+        df['revenue_sum'] = df['revenue_sum'].astype(float)
+        return df
+    return _cached(engine, config, 'GetUserFunnelByUser', start_date, end_date, compute)
+
+def get_monthly_user_stats(engine, config, first_month, last_month):
+    """Rows of vw_MonthlyUserStats for months from first_month to last_month"""
+    def compute():
+        if use_event_store(config):
+            import event_store
+            return event_store.monthly_user_stats(event_store_dir(config), first_month, last_month)
+        if use_local_engine(config):
+            import local_engine
+            return local_engine.monthly_user_stats(snapshot_dir(config), first_month, last_month)
+        sql_str = f"SELECT * FROM [dbo].[vw_MonthlyUserStats] WHERE month BETWEEN {first_month} AND {last_month}"
+        df = pd.read_sql(sql_str, con=engine)
+        df['user_revenue'] = df['user_revenue'].astype(float)
+        return df
+    return _cached(engine, config, 'vw_MonthlyUserStats', first_month, last_month, compute)
+
+def get_monthly_revenue_stats(engine, config, first_month, last_month):
+    """Rows of vw_MonthlyRevenueStats for months from first_month to last_month"""
+    if use_event_store(config) or use_local_engine(config):
+        user_stats = get_monthly_user_stats(engine, config, first_month, last_month)
+        return (user_stats.groupby('month')['user_revenue']
+                .agg(num_users='size', mean_revenue='mean', var_revenue='var').reset_index())
+    sql_str = f"SELECT * FROM [dbo].[vw_MonthlyRevenueStats] WHERE month BETWEEN {first_month} AND {last_month}"
+    return pd.read_sql(sql_str, con=engine)
+
+def get_monthly_funnel(engine, config, first_month, last_month):
+    """Rows of vw_MonthlyFunnel (without num_add_to_basket for local sources) for months from first_month to last_month"""
+    if use_event_store(config) or use_local_engine(config):
+        user_stats = get_monthly_user_stats(engine, config, first_month, last_month)
+        funnel = (user_stats.groupby('month')[['has_view', 'has_checkout', 'has_purchase']].sum()
+                  .set_axis(['num_view', 'num_checkout', 'num_purchase'], axis='columns').reset_index())
+        funnel['conversion_rate'] = funnel['num_purchase'] / funnel['num_checkout'].replace(0, np.nan)
+        return funnel
+    sql_str = f"SELECT * FROM [dbo].[vw_MonthlyFunnel] WHERE month BETWEEN {first_month} AND {last_month}"
+    return pd.read_sql(sql_str, con=engine)
@@ -0,0 +1,237 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import data_exchange
+import event_table
+import local_engine
+from event_table import EventTable, NULL_TIMESTAMP
+
+NS_PER_DAY = 86_400 * 10**9
+CODE_COLUMNS = {'user_code': np.int32, 'event_type_code': np.uint8, 'event_timestamp': np.int64,
+                'device_code': np.uint8, 'revenue_cents': np.int32}
+
+class EventStore:
+    """Append-only local store of EventLogs as date-partitioned, memory-mapped column files.
+
+    Every append writes one part per event date: partitions/date=YYYY-MM-DD/part-NNNNN/ with one .npy file
+    per EventTable column, rows sorted by event_timestamp, and users.npy with the sorted user codes of the part.
+    manifest.json holds the zone map of every part (rows, min/max event_timestamp and user code) and the
+    event_type and device dictionaries, user_ids.txt the user id of every user code, one per line.
+    Old parts are never rewritten, a query opens only the parts whose zone map overlaps the window.
+    Events without event_timestamp go to date=null, which no window selects as in SQL.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        manifest_path = os.path.join(store_dir, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'event_types': event_table.EVENT_TYPES, 'devices': event_table.DEVICES, 'parts': []}
+        users_path = os.path.join(store_dir, 'user_ids.txt')
+        self.user_ids = []
+        if os.path.exists(users_path):
+            with open(users_path) as f:
+                self.user_ids = f.read().splitlines()
+        self._user_codes = {user_id: code for code, user_id in enumerate(self.user_ids)}
+        self._user_ids_array = None
+
+    def _encode(self, values, dictionary, positions):
+        codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+        if (codes < 0).any():
+            raise ValueError("NULL user_id, event_type or device can not be stored")
+        mapping = []
+        for value in uniques:
+            if value not in positions:
+                positions[value] = len(dictionary)
+                dictionary.append(value)
+            mapping.append(positions[value])
+        return np.array(mapping, dtype=np.int64)[codes]
+
+    def append(self, events):
+        """Adds events (DataFrame with the EventLogs columns or EventTable) as new parts, returns the number of parts"""
+        if isinstance(events, EventTable):
+            events = events.to_frame()
+        if events.empty:
+            return 0
+        num_users = len(self.user_ids)
+        columns = {'user_code': self._encode(events['user_id'], self.user_ids, self._user_codes)}
+        for name, column, dict_name in [('event_type_code', 'event_type', 'event_types'), ('device_code', 'device', 'devices')]:
+            dictionary = self.manifest[dict_name]
+            columns[name] = self._encode(events[column], dictionary, {v: i for i, v in enumerate(dictionary)})
+            if len(dictionary) > 255:
+                raise ValueError(f"More than 255 {dict_name} do not fit into uint8 codes")
+        columns['event_timestamp'] = event_table.encode_timestamps(events['event_timestamp'])
+        columns['revenue_cents'] = event_table.encode_revenue(events['revenue'])
+
+        # New user ids go first: parts written after a crash are not in the manifest and are never read
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(os.path.join(self.store_dir, 'user_ids.txt'), 'a') as f:
+            f.writelines(f"{user_id}\n" for user_id in self.user_ids[num_users:])
+        self._user_ids_array = None
+
+        ts = columns['event_timestamp']
+        days = np.where(ts == NULL_TIMESTAMP, np.iinfo(np.int64).min, ts // NS_PER_DAY)
+        order = np.lexsort((ts, days))
+        days = days[order]
+        bounds = np.flatnonzero(np.diff(days)) + 1
+        parts = np.split(order, bounds)
+        for rows in parts:
+            self._write_part({name: values[rows] for name, values in columns.items()})
+        self._save_manifest()
+        return len(parts)
+
+    def _write_part(self, columns):
+        ts = columns['event_timestamp']
+        date = 'null' if ts[0] == NULL_TIMESTAMP else pd.Timestamp(ts[0]).strftime("%Y-%m-%d")
+        part_index = sum(1 for p in self.manifest['parts'] if p['date'] == date)
+        path = os.path.join('partitions', f"date={date}", f"part-{part_index:05d}")
+        os.makedirs(os.path.join(self.store_dir, path), exist_ok=True)
+        for name, dtype in CODE_COLUMNS.items():
+            np.save(os.path.join(self.store_dir, path, f"{name}.npy"), columns[name].astype(dtype))
+        # User-id index of the part: sorted distinct user codes
+        users = np.unique(columns['user_code'])
+        np.save(os.path.join(self.store_dir, path, 'users.npy'), users.astype(np.int32))
+        self.manifest['parts'].append({
+            'date': date, 'path': path, 'rows': int(len(ts)),
+            'min_ts': int(ts[0]), 'max_ts': int(ts[-1]),
+            'min_user': int(users[0]), 'max_user': int(users[-1])
+        })
+
+    def _save_manifest(self):
+        path = os.path.join(self.store_dir, 'manifest.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(path + '.tmp', path)
+
+    def parts(self, start=None, end=None):
+        """Zone maps of the dated parts overlapping [start, end]"""
+        start = NULL_TIMESTAMP + 1 if start is None else pd.Timestamp(start).value
+        end = np.iinfo(np.int64).max if end is None else pd.Timestamp(end).value
+        return [p for p in self.manifest['parts'] if p['date'] != 'null' and p['max_ts'] >= start and p['min_ts'] <= end]
+
+    def _user_id_array(self):
+        if self._user_ids_array is None:
+            self._user_ids_array = np.asarray(self.user_ids, dtype=object)
+        return self._user_ids_array
+
+    def _open(self, part, rows=slice(None)):
+        """EventTable over the memory-mapped columns of a part, rows is a slice so no data is copied"""
+        columns = {name: np.load(os.path.join(self.store_dir, part['path'], f"{name}.npy"), mmap_mode='r')[rows]
+                   for name in CODE_COLUMNS}
+        return EventTable(columns['user_code'], self._user_id_array(), columns['event_type_code'],
+                          self.manifest['event_types'], columns['event_timestamp'], columns['device_code'],
+                          self.manifest['devices'], columns['revenue_cents'])
+
+    def iter_tables(self, start=None, end=None):
+        """Yields a zero-copy EventTable per part with the events of [start, end].
+        Parts inside the window are mapped whole, rows of edge parts are cut by binary search on the sorted timestamps.
+        """
+        for part in self.parts(start, end):
+            rows = slice(None)
+            if start is not None and part['min_ts'] < pd.Timestamp(start).value:
+                ts = np.load(os.path.join(self.store_dir, part['path'], 'event_timestamp.npy'), mmap_mode='r')
+                rows = slice(np.searchsorted(ts, pd.Timestamp(start).value, side='left'), rows.stop)
+            if end is not None and part['max_ts'] > pd.Timestamp(end).value:
+                ts = np.load(os.path.join(self.store_dir, part['path'], 'event_timestamp.npy'), mmap_mode='r')
+                rows = slice(rows.start, np.searchsorted(ts, pd.Timestamp(end).value, side='right'))
+            table = self._open(part, rows)
+            if len(table):
+                yield table
+
+    def read(self, start=None, end=None)->EventTable:
+        """Events of [start, end] as one EventTable. A single part is returned without copying,
+        several parts are concatenated (all parts share the store dictionaries).
+        """
+        tables = list(self.iter_tables(start, end))
+        if len(tables) == 1:
+            return tables[0]
+        if not tables:
+            return EventTable(np.zeros(0, dtype=np.int32), self._user_id_array(), np.zeros(0, dtype=np.uint8),
+                              self.manifest['event_types'], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8),
+                              self.manifest['devices'], np.zeros(0, dtype=np.int32))
+        columns = {name: np.concatenate([getattr(t, name) for t in tables]) for name in CODE_COLUMNS}
+        return EventTable(columns['user_code'], self._user_id_array(), columns['event_type_code'],
+                          self.manifest['event_types'], columns['event_timestamp'], columns['device_code'],
+                          self.manifest['devices'], columns['revenue_cents'])
+
+    def user_events(self, user_id)->pd.DataFrame:
+        """Events of one user. Parts are skipped by the user code zone map and the users.npy index."""
+        code = self._user_codes.get(user_id)
+        frames = []
+        for part in self.manifest['parts']:
+            if code is None or not part['min_user'] <= code <= part['max_user']:
+                continue
+            users = np.load(os.path.join(self.store_dir, part['path'], 'users.npy'), mmap_mode='r')
+            i = np.searchsorted(users, code)
+            if i < len(users) and users[i] == code:
+                table = self._open(part)
+                frames.append(table.take(np.flatnonzero(table.user_code == code)).to_frame())
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=event_table.COLUMNS)
+
+    def append_assignments(self, df_users):
+        """Adds UserAssignments rows as a new Parquet part"""
+        assignments_dir = os.path.join(self.store_dir, 'assignments')
+        os.makedirs(assignments_dir, exist_ok=True)
+        part_index = len(os.listdir(assignments_dir))
+        df_users.to_parquet(os.path.join(assignments_dir, f"part-{part_index:05d}.parquet"), index=False)
+
+    def read_assignments(self)->pd.DataFrame:
+        return pd.read_parquet(os.path.join(self.store_dir, 'assignments'),
+                               columns=['user_id', 'experiment_id', 'test_group'])
+
+    def data_version(self):
+        """Changes with every append of events or assignments"""
+        assignments_dir = os.path.join(self.store_dir, 'assignments')
+        num_assignment_parts = len(os.listdir(assignments_dir)) if os.path.exists(assignments_dir) else 0
+        return (len(self.manifest['parts']), sum(p['rows'] for p in self.manifest['parts']), num_assignment_parts)
+
+def store_chunks(chunks, store):
+    """Passes chunks through while appending them to the store"""
+    for df in chunks:
+        store.append(df)
+        yield df
+
+def basic_stat_by_group(store_dir, start_date, end_date)->pd.DataFrame:
+    store = EventStore(store_dir)
+    return local_engine.get_basic_stat_by_group(store.read(start_date, local_engine._window_end(end_date)),
+                                                store.read_assignments(), start_date, end_date)
+
+def total_revenue_by_user(store_dir, start_date, end_date)->pd.DataFrame:
+    store = EventStore(store_dir)
+    return local_engine.get_total_revenue_by_user(store.read(start_date, local_engine._window_end(end_date)),
+                                                  store.read_assignments(), start_date, end_date)
+
+def revenue_histogram_by_group(store_dir, start_date, end_date)->pd.DataFrame:
+    store = EventStore(store_dir)
+    return local_engine.get_revenue_histogram_by_group(store.read(start_date, local_engine._window_end(end_date)),
+                                                       store.read_assignments(), start_date, end_date)
+
+def user_funnel(store_dir, start_date, end_date)->pd.DataFrame:
+    store = EventStore(store_dir)
+    return local_engine.get_user_funnel(store.read(start_date, local_engine._window_end(end_date)),
+                                        store.read_assignments(), start_date, end_date)
+
+def monthly_user_stats(store_dir, first_month, last_month)->pd.DataFrame:
+    return local_engine.get_monthly_user_stats(EventStore(store_dir).read(), first_month, last_month)
+
+def segment_stats(store_dir, start_date, end_date)->pd.DataFrame:
+    store = EventStore(store_dir)
+    return local_engine.get_segment_stats(store.read(end=local_engine._window_end(end_date)),
+                                          store.read_assignments(), start_date, end_date)
+
+def import_from_db(engine, store_dir, chunksize=1_000_000):
+    """Appends all EventLogs and UserAssignments rows of the database to the store"""
+    store = EventStore(store_dir)
+    for df in pd.read_sql("SELECT user_id, event_type, event_timestamp, device, revenue FROM EventLogs",
+                          con=engine, chunksize=chunksize):
+        store.append(df)
+    store.append_assignments(pd.read_sql("SELECT user_id, experiment_id, test_group, assigned_at FROM UserAssignments", con=engine))
+    print(f"EventLogs and UserAssignments imported into {store_dir}.")
+    return store
+
+if __name__ == "__main__":
+    # One-off import of an existing database, new data is appended by generate_ecomm_data with ENGINE = store
+    config, engine = data_exchange.connect_to_db()
+    import_from_db(engine, data_exchange.event_store_dir(config), int(config['DATA'].get('CHUNK_SIZE', 1_000_000)))
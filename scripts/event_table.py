@@ -0,0 +1,156 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+COLUMNS = ['user_id', 'event_type', 'event_timestamp', 'device', 'revenue']
+EVENT_TYPES = ['view', 'add_to_basket', 'checkout', 'purchase']
+DEVICES = ['mobile', 'desktop', 'tablet']
+
+# NULL markers: NaT is the smallest int64 as in numpy, NULL revenue is the smallest int32.
+# NULL strings are a None entry of the dictionary.
+NULL_TIMESTAMP = np.iinfo(np.int64).min
+NULL_CENTS = np.iinfo(np.int32).min
+
+def _encode(values, dictionary):
+    """Codes of values in the dictionary, new values (and None for NULL) are appended to it"""
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object), use_na_sentinel=False)
+    dictionary = list(dictionary)
+    positions = {v: i for i, v in enumerate(dictionary)}
+    mapping = []
+    for value in uniques:
+        value = None if pd.isna(value) else value
+        if value not in positions:
+            positions[value] = len(dictionary)
+            dictionary.append(value)
+        mapping.append(positions[value])
+    return np.array(mapping, dtype=np.int64)[codes], dictionary
+
+def encode_timestamps(values)->np.ndarray:
+    """int64 nanoseconds since epoch, NULL_TIMESTAMP for NULL"""
+    return pd.to_datetime(values).to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+def encode_revenue(values)->np.ndarray:
+    """int32 cents, NULL_CENTS for NULL"""
+    cents = np.round(pd.Series(values).to_numpy(dtype=float, na_value=np.nan) * 100)
+    if np.nanmax(np.abs(cents), initial=0) >= -NULL_CENTS:
+        raise ValueError("Revenue does not fit into int32 cents")
+    return np.where(np.isnan(cents), NULL_CENTS, cents).astype(np.int32)
+
+def _code_dtype(dictionary):
+    return np.uint8 if len(dictionary) <= 256 else np.int32
+
+class EventTable:
+    """EventLogs rows as integer columns, 18 bytes per event plus the dictionary of distinct user ids.
+
+    user_code (int32) indexes the user_ids dictionary, event_type_code and device_code (uint8) index
+    event_types and devices, event_timestamp is int64 nanoseconds since epoch and revenue_cents is int32.
+    to_frame() returns exactly the rows given to from_frame() as long as revenue has at most
+    2 decimal places, as in DECIMAL(18, 2).
+    """
+    def __init__(self, user_code, user_ids, event_type_code, event_types, event_timestamp, device_code, devices, revenue_cents):
+        self.user_code = user_code
+        self.user_ids = user_ids
+        self.event_type_code = event_type_code
+        self.event_types = list(event_types)
+        self.event_timestamp = event_timestamp
+        self.device_code = device_code
+        self.devices = list(devices)
+        self.revenue_cents = revenue_cents
+
+    @staticmethod
+    def from_frame(df, user_ids=(), event_types=EVENT_TYPES, devices=DEVICES):
+        """Encodes EventLogs rows, the user_ids, event_types and devices dictionaries are extended with new values"""
+        user_code, user_ids = _encode(df['user_id'], user_ids)
+        event_type_code, event_types = _encode(df['event_type'], event_types)
+        device_code, devices = _encode(df['device'], devices)
+        return EventTable(user_code.astype(np.int32), np.asarray(user_ids, dtype=object),
+                          event_type_code.astype(_code_dtype(event_types)), event_types,
+                          encode_timestamps(df['event_timestamp']),
+                          device_code.astype(_code_dtype(devices)), devices,
+                          encode_revenue(df['revenue']))
+
+    @staticmethod
+    def from_arrow(table):
+        """Encodes a pyarrow table, e.g. the Parquet snapshot read with read_dictionary for the string columns.
+        Dictionary indices become the codes, no Python string is built per event.
+        """
+        codes, dictionaries = {}, {}
+        for name in ['user_id', 'event_type', 'device']:
+            column = table.column(name)
+            if not pa.types.is_dictionary(column.type):
+                column = column.dictionary_encode()
+            column = column.unify_dictionaries()
+            dictionary = column.chunk(0).dictionary.to_pylist() if column.num_chunks else []
+            indices = pa.chunked_array([c.indices for c in column.chunks], type=column.type.index_type)
+            if indices.null_count:
+                indices = indices.fill_null(len(dictionary))
+                dictionary.append(None)
+            codes[name] = indices.to_numpy().astype(np.int32)
+            dictionaries[name] = dictionary
+        timestamps = table.column('event_timestamp').cast(pa.timestamp('ns')).cast(pa.int64())
+        cents = pc.round(pc.multiply(table.column('revenue').cast(pa.float64()), 100))
+        return EventTable(codes['user_id'], np.asarray(dictionaries['user_id'], dtype=object),
+                          codes['event_type'].astype(_code_dtype(dictionaries['event_type'])), dictionaries['event_type'],
+                          timestamps.fill_null(NULL_TIMESTAMP).to_numpy(),
+                          codes['device'].astype(_code_dtype(dictionaries['device'])), dictionaries['device'],
+                          cents.fill_null(NULL_CENTS).to_numpy().astype(np.int32))
+
+    def __len__(self):
+        return len(self.user_code)
+
+    @property
+    def nbytes(self)->int:
+        """Bytes of the columns, the user_ids dictionary is not included"""
+        return sum(a.nbytes for a in [self.user_code, self.event_type_code, self.event_timestamp,
+                                      self.device_code, self.revenue_cents])
+
+    def take(self, rows):
+        """EventTable of the selected rows (boolean mask or positions), dictionaries are shared"""
+        return EventTable(self.user_code[rows], self.user_ids, self.event_type_code[rows], self.event_types,
+                          self.event_timestamp[rows], self.device_code[rows], self.devices, self.revenue_cents[rows])
+
+    def window(self, start, end):
+        """Events with start <= event_timestamp <= end, NULL timestamps are excluded as in SQL"""
+        ts = self.event_timestamp
+        return self.take((ts >= pd.Timestamp(start).value) & (ts <= pd.Timestamp(end).value) & (ts != NULL_TIMESTAMP))
+
+    def to_frame(self, categorical=False)->pd.DataFrame:
+        """EventLogs DataFrame. With categorical=True the string columns are categoricals over the codes,
+        so local_engine can work on them without a Python string per event.
+        """
+        def decode(codes, dictionary):
+            if not categorical:
+                return np.asarray(dictionary, dtype=object)[codes]
+            # NULL is code -1 in a Categorical, not a category
+            keep = np.array([v is not None for v in dictionary], dtype=bool)
+            remap = np.where(keep, np.cumsum(keep) - 1, -1)
+            return pd.Categorical.from_codes(remap[codes], categories=pd.Index(np.asarray(dictionary, dtype=object)[keep], dtype=object))
+
+        revenue = self.revenue_cents / 100
+        revenue[self.revenue_cents == NULL_CENTS] = np.nan
+        timestamps = self.event_timestamp.view('datetime64[ns]')
+        return pd.DataFrame({
+            'user_id': decode(self.user_code, self.user_ids),
+            'event_type': decode(self.event_type_code, self.event_types),
+            'event_timestamp': timestamps,
+            'device': decode(self.device_code, self.devices),
+            'revenue': revenue
+        })
+
+def concat(tables)->EventTable:
+    """Concatenates tables, codes are remapped to the dictionaries of the first table extended with new values"""
+    tables = list(tables)
+    dictionaries = {'user_ids': list(tables[0].user_ids), 'event_types': tables[0].event_types, 'devices': tables[0].devices}
+    columns = {'user_code': [], 'event_type_code': [], 'device_code': []}
+    for table in tables:
+        for code_name, dict_name in [('user_code', 'user_ids'), ('event_type_code', 'event_types'), ('device_code', 'devices')]:
+            mapping, dictionaries[dict_name] = _encode(getattr(table, dict_name), dictionaries[dict_name])
+            columns[code_name].append(mapping[getattr(table, code_name)])
+    return EventTable(np.concatenate(columns['user_code']).astype(np.int32), np.asarray(dictionaries['user_ids'], dtype=object),
+                      np.concatenate(columns['event_type_code']).astype(_code_dtype(dictionaries['event_types'])),
+                      dictionaries['event_types'],
+                      np.concatenate([t.event_timestamp for t in tables]),
+                      np.concatenate(columns['device_code']).astype(_code_dtype(dictionaries['devices'])),
+                      dictionaries['devices'],
+                      np.concatenate([t.revenue_cents for t in tables]))
@@ -9,6 +9,10 @@ import os
 import matplotlib.pyplot as plt
 import scipy as sp
 import data_exchange
+import instrumentation
+import query_cache
+import power_simulation
+import cuped
 
 
 def sample_sizing(history_var, mde, alpha=0.05, power=0.8):
@@ -18,9 +22,8 @@ def sample_sizing(history_var, mde, alpha=0.05, power=0.8):
     return n
 
 # Size of sample for ARPU
-def arpu_sample_sizing(engine, first_history_month, last_history_month, alpha=0.05, power=0.8):
-    sql_str_for_events = f"SELECT * FROM [dbo].[vw_MonthlyRevenueStats] WHERE month BETWEEN {first_history_month} AND {last_history_month}"
-    df_revenue_stats_by_month = pd.read_sql(sql_str_for_events, con=engine)
+def arpu_sample_sizing(engine, config, first_history_month, last_history_month, alpha=0.05, power=0.8):
+    df_revenue_stats_by_month = data_exchange.get_monthly_revenue_stats(engine, config, first_history_month, last_history_month)
     
     history_revenue_mean = df_revenue_stats_by_month['mean_revenue'].mean()
     history_revenue_var = df_revenue_stats_by_month['var_revenue'].mean()
@@ -38,9 +41,8 @@ def arpu_sample_sizing(engine, first_history_month, last_history_month, alpha=0.
     print(f"Expected duration of experiment {revenue_duration:.2} months")
     return [history_revenue_mean, history_revenue_var, revenue_mde, rev_sampling_size, revenue_duration]
 
-def cr_sample_sizing(engine, first_history_month, last_history_month, alpha=0.05, power=0.8):
-    sql_str_for_events = f"SELECT * FROM [dbo].[vw_MonthlyFunnel] WHERE month BETWEEN {first_history_month} AND {last_history_month}"
-    df_cr_stats_by_month = pd.read_sql(sql_str_for_events, con=engine)
+def cr_sample_sizing(engine, config, first_history_month, last_history_month, alpha=0.05, power=0.8):
+    df_cr_stats_by_month = data_exchange.get_monthly_funnel(engine, config, first_history_month, last_history_month)
 
     history_cr_mean = df_cr_stats_by_month['conversion_rate'].mean()
     history_cr_var = history_cr_mean*(1-history_cr_mean)
@@ -58,15 +60,15 @@ def cr_sample_sizing(engine, first_history_month, last_history_month, alpha=0.05
     print(f"Expected duration of experiment {cr_duration:.2} months")
     return [history_cr_mean, history_cr_var, cr_mde, cr_sampling_size, cr_duration]
 
-if __name__ == "__main__":
-
-    config, engine = data_exchange.connect_to_db()
+def run(config, engine, assets_dir='.//assets'):
+    """Sample size and duration for ARPU and CR from the history months, saved to assets_dir"""
     last_history_month = int(datetime.strptime(config['DATA']['HISTORY_END_DATE'], "%d-%m-%Y").month)
     first_history_month = last_history_month-2
     
 
     # ARPU = Total revenue / Unique users with view
     arpu_stat = arpu_sample_sizing(engine, 
+                                   config,
                                    first_history_month, 
                                    last_history_month, 
                                    float(config['EXPERIMENT']['ALPHA']), 
@@ -75,6 +77,7 @@ if __name__ == "__main__":
 
     # Number of users for CR = Unique users with purchase / Unique users with checkout
     cr_stat = cr_sample_sizing(engine, 
+                                   config,
                                    first_history_month, 
                                    last_history_month, 
                                    float(config['EXPERIMENT']['ALPHA']), 
@@ -82,8 +85,43 @@ if __name__ == "__main__":
     metric_stats = [arpu_stat,  cr_stat]
     metric_stats = pd.DataFrame(metric_stats, columns=['history_mean', 'history_var', 'mde', 'size', 'duration_months'])
     metric_stats = metric_stats.set_axis(["ARPU", "CR"], axis='index')
+
+    # CUPED shrinks the variance by corr(pre-period, test window)**2, estimated with the last history month as the test window
+    if config.getboolean('CUPED', 'ENABLED', fallback=False):
+        df_user_stats = data_exchange.get_monthly_user_stats(engine, config, first_history_month, last_history_month)
+        reduction = pd.Series(cuped.history_variance_reduction(df_user_stats, last_history_month))
+        metric_stats['cuped_variance_reduction'] = reduction
+        metric_stats['cuped_size'] = (metric_stats['size'] * (1 - reduction)).astype(int)
+        metric_stats['cuped_duration_months'] = metric_stats['duration_months'] * (1 - reduction)
+        for metric, row in metric_stats.iterrows():
+            print(f"CUPED reduces {metric} variance by {row['cuped_variance_reduction']:.1%}: "
+                  f"expected {int(row['cuped_size'])} users, duration {row['cuped_duration_months']:.2} months")
     
     # Write to csv
-    metric_stats.to_csv('.//assets//metrics_stats.csv', float_format="%.2f",index=True, mode='w')
+    metric_stats.to_csv(os.path.join(assets_dir, 'metrics_stats.csv'), float_format="%.2f",index=True, mode='w')
 
-        
\ No newline at end of file
+        
+
+    # Monte Carlo power on resampled history, the closed form above assumes normality
+    if config.getboolean('POWER SIMULATION', 'ENABLED', fallback=False):
+        sim_config = config['POWER SIMULATION']
+        def parse_list(key, default):
+            return [float(x) for x in sim_config.get(key, default).split(',')]
+        size_multipliers = parse_list('SIZE_MULTIPLIERS', '0.25,0.5,1,1.5,2')
+        grid = {
+            'ARPU': (parse_list('MDES_ARPU', '0.05,0.1,0.15'), [max(10, int(arpu_stat[3] * m)) for m in size_multipliers]),
+            'CR': (parse_list('MDES_CR', '0.025,0.05,0.1'), [max(10, int(cr_stat[3] * m)) for m in size_multipliers])
+        }
+        df_user_stats = data_exchange.get_monthly_user_stats(engine, config, first_history_month, last_history_month)
+        cache = query_cache.QueryCache(config.get('CACHE', 'DIR', fallback='.//data//cache'))
+        surface = power_simulation.cached_power_surface(cache, df_user_stats, first_history_month, last_history_month,
+                                                        grid, parse_list('ALPHAS', '0.01,0.05,0.1'),
+                                                        int(sim_config.get('REPLICATES', '500')),
+                                                        int(sim_config.get('WORKERS', '0')) or None)
+        surface.to_csv(os.path.join(assets_dir, 'power_surface.csv'), float_format="%.4f", index=False, mode='w')
+        print(f"Power surface with {len(surface)} points saved to assets/power_surface.csv")
+
+if __name__ == "__main__":
+    config, engine = data_exchange.connect_to_db()
+    with instrumentation.span('size'):
+        run(config, engine)
@@ -6,7 +6,12 @@ import random
 from datetime import datetime, timedelta
 import configparser
 import os
+import shutil
 import data_exchange
+import instrumentation
+import bulk_loader
+import assignment
+import sequential_testing
 
 def generate_experiment_descr(test_name, test_h0)  -> pd.DataFrame:
     experiment_descr = [test_name, test_h0, 'running']
@@ -15,14 +20,13 @@ def generate_experiment_descr(test_name, test_h0)  -> pd.DataFrame:
 
 def generate_users(num_users: int, experiment_id:int) -> pd.DataFrame:
     user_ids = [str(fake.unique.uuid4()) for _ in range(num_users)]
-    df_users = pd.DataFrame({
-        'user_id': user_ids,
-        'experiment_id' : experiment_id,
-        'test_group': ['A' if (hash(id) % 2)<1 else 'B' for id in user_ids],
-        'assigned_at': datetime.today()
-    })
+    # Stable split: the same user lands in the same group on every run
+    df_users = assignment.build_assignments(user_ids, experiment_id)
     return df_users
 
+DEVICES = ['mobile', 'desktop', 'tablet']
+DEVICE_PROBS = [0.6, 0.3, 0.1]
+
 def generate_session(uid, group, start_date, end_date, is_test_period=False)->list:
     """Generates a sequence of events with varying devices and conditional revenue
     Return list of ['user_id', 'event_type', 'event_timestamp', 'device', 'revenue']-list
@@ -30,7 +34,7 @@ def generate_session(uid, group, start_date, end_date, is_test_period=False)->li
     events = []
     ts = fake.date_time_between(start_date=start_date, end_date=end_date)
     # Device can change between sessions
-    session_device = np.random.choice(['mobile', 'desktop', 'tablet'], p=[0.6, 0.3, 0.1])
+    session_device = np.random.choice(DEVICES, p=DEVICE_PROBS)
     
     # Uplift logic for test period
     cr = 0.6
@@ -55,27 +59,124 @@ def generate_session(uid, group, start_date, end_date, is_test_period=False)->li
 
 def generate_events(df_users: pd.DataFrame, 
                     start_history_date: datetime, end_history_date:datetime,
-                    start_test_date: datetime, end_test_date:datetime)->pd.DataFrame:
+                    start_test_date: datetime, end_test_date:datetime, seed=None)->pd.DataFrame:
     # Generate History and Test
-    events = list([])
-    num_history_days = (end_history_date - start_history_date).days
-    num_test_days = (end_test_date - end_history_date).days
-    for _, row in df_users.iterrows():
-        # events are randomly distributed by days in period, 
-        # number of generated events should scale proportionally with the length of period
-        for i in range(round(num_history_days/10)):
-            history_session = generate_session(row['user_id'], row['test_group'], start_history_date, end_history_date, False)
-            events = history_session + events
-        for i in range(round(num_test_days/10)):
-            test_session = generate_session(row['user_id'], row['test_group'], start_test_date, end_test_date, True)
-            events = test_session + events  
-
-    return pd.DataFrame(events, columns=['user_id', 'event_type', 'event_timestamp', 'device', 'revenue'])
+    chunks = generate_event_chunks(df_users, start_history_date, end_history_date,
+                                   start_test_date, end_test_date, seed=seed)
+    return pd.concat(list(chunks), ignore_index=True)
 
-if __name__ == "__main__":
+def _draw_sessions(rng, num_sessions, start_date, end_date):
+    """Draws session start timestamps uniformly in [start_date, end_date] and session devices"""
+    period_seconds = int((end_date - start_date).total_seconds())
+    offsets = rng.integers(0, period_seconds, size=num_sessions, endpoint=True)
+    ts = np.datetime64(start_date, 's') + offsets.astype('timedelta64[s]')
+    devices = rng.choice(DEVICES, size=num_sessions, p=DEVICE_PROBS)
+    return ts, devices
+
+def generate_events_block(rng, user_ids, test_groups,
+                          start_history_date, end_history_date,
+                          start_test_date, end_test_date, 
+                          num_history_sessions, num_test_sessions)->pd.DataFrame:
+    """Generates events for a block of users at once.
+    Same funnel as generate_session: view -> add_to_basket (0.4) -> checkout (0.5) -> purchase (cr),
+    where group B gets higher CR and revenue multiplier in the test period.
+    """
+    num_users = len(user_ids)
+    # Session i belongs to user session_user[i]; history sessions go first, then test sessions
+    session_user = np.concatenate([np.repeat(np.arange(num_users), num_history_sessions),
+                                   np.repeat(np.arange(num_users), num_test_sessions)])
+    is_test = np.concatenate([np.zeros(num_users*num_history_sessions, dtype=bool),
+                              np.ones(num_users*num_test_sessions, dtype=bool)])
+    num_sessions = len(session_user)
+
+    hist_ts, hist_devices = _draw_sessions(rng, num_users*num_history_sessions, start_history_date, end_history_date)
+    test_ts, test_devices = _draw_sessions(rng, num_users*num_test_sessions, start_test_date, end_test_date)
+    ts = np.concatenate([hist_ts, test_ts])
+    devices = np.concatenate([hist_devices, test_devices])
+
+    # Uplift logic for test period
+    is_uplift = is_test & (test_groups[session_user] == 'B')
+    cr = np.where(is_uplift, 0.63, 0.6)
+    rev_mult = np.where(is_uplift, 1.04, 1.0)
+
+    # Funnel progression
+    has_basket = rng.random(num_sessions) < 0.4
+    has_checkout = has_basket & (rng.random(num_sessions) < 0.5)
+    has_purchase = has_checkout & (rng.random(num_sessions) < cr)
+    revenue = np.round(rng.lognormal(3.5, 0.8, num_sessions) * rev_mult, 2)
+
+    steps = [('view', np.ones(num_sessions, dtype=bool), 0),
+             ('add_to_basket', has_basket, 2),
+             ('checkout', has_checkout, 5),
+             ('purchase', has_purchase, 7)]
+    session_idx = np.concatenate([np.flatnonzero(mask) for _, mask, _ in steps])
+    step_idx = np.concatenate([np.full(mask.sum(), i) for i, (_, mask, _) in enumerate(steps)])
+    # Keep events of one session together and in funnel order
+    order = np.lexsort((step_idx, session_idx))
+    session_idx = session_idx[order]
+    step_idx = step_idx[order]
+
+    event_types = np.array([name for name, _, _ in steps])
+    minutes = np.array([m for _, _, m in steps], dtype='timedelta64[m]')
+    return pd.DataFrame({
+        'user_id': user_ids[session_user[session_idx]],
+        'event_type': event_types[step_idx],
+        'event_timestamp': ts[session_idx] + minutes[step_idx],
+        'device': devices[session_idx],
+        'revenue': np.where(step_idx == 3, revenue[session_idx], np.nan)
+    })
+
+def generate_event_chunks(df_users: pd.DataFrame, 
+                          start_history_date: datetime, end_history_date:datetime,
+                          start_test_date: datetime, end_test_date:datetime,
+                          chunk_size=1_000_000, users_per_block=50_000, seed=None):
+    """Yields events for all users as DataFrames of chunk_size rows (the last one can be smaller).
+    Users are processed in blocks of users_per_block, so memory is bounded by block and chunk size.
+    Runs with the same seed and users_per_block produce the same events.
+    """
+    rng = np.random.default_rng(seed)
+    # events are randomly distributed by days in period, 
+    # number of generated events should scale proportionally with the length of period
+    num_history_sessions = round((end_history_date - start_history_date).days/10)
+    num_test_sessions = round((end_test_date - end_history_date).days/10)
+    user_ids = df_users['user_id'].to_numpy()
+    test_groups = df_users['test_group'].to_numpy()
+
+    buffer = []
+    buffered_rows = 0
+    for block_start in range(0, len(user_ids), users_per_block):
+        block = slice(block_start, block_start + users_per_block)
+        df_block = generate_events_block(rng, user_ids[block], test_groups[block],
+                                         start_history_date, end_history_date,
+                                         start_test_date, end_test_date,
+                                         num_history_sessions, num_test_sessions)
+        buffer.append(df_block)
+        buffered_rows += len(df_block)
+        if buffered_rows < chunk_size:
+            continue
+        df_buffer = pd.concat(buffer, ignore_index=True)
+        num_full = len(df_buffer) // chunk_size
+        for i in range(num_full):
+            yield df_buffer.iloc[i*chunk_size:(i+1)*chunk_size].reset_index(drop=True)
+        buffer = [df_buffer.iloc[num_full*chunk_size:].reset_index(drop=True)]
+        buffered_rows = len(buffer[0])
+    if buffered_rows > 0:
+        yield pd.concat(buffer, ignore_index=True)
+
+def observe_chunks(chunks, accumulator, test_groups):
+    """Passes chunks through while updating the sequential test accumulator"""
+    for df in chunks:
+        accumulator.update(df, test_groups)
+        yield df
+
+def run(config, engine, if_exists='replace'):
+    """Creates a new experiment with generated users and events.
+    Use if_exists='append' to keep the data of other experiments.
+    Returns: experiment_id.
+    """
+    global fake
     fake = Faker()
     np.random.seed(42)
-    config, engine = data_exchange.connect_to_db()
 
     df_experiment = generate_experiment_descr(config['EXPERIMENT']['NAME'], config['EXPERIMENT']['H0'])
     df_experiment.to_sql('Experiments', con=engine, if_exists='append', index=False)
@@ -87,16 +188,42 @@ if __name__ == "__main__":
     len_a =  (df_users['test_group'] == 'A').sum()
     print((f"Unique users in group A {len_a} and in group B {len(df_users) - len_a}"))
     
-    df_events = generate_events(df_users, datetime.strptime(config['DATA']['HISTORY_START_DATE'], "%d-%m-%Y"), datetime.strptime(config['DATA']['HISTORY_END_DATE'], "%d-%m-%Y"),
-                                datetime.strptime(config['DATA']['TEST_START_DATE'], "%d-%m-%Y"), datetime.strptime(config['DATA']['TEST_END_DATE'], "%d-%m-%Y"))
+    event_chunks = generate_event_chunks(df_users, datetime.strptime(config['DATA']['HISTORY_START_DATE'], "%d-%m-%Y"), datetime.strptime(config['DATA']['HISTORY_END_DATE'], "%d-%m-%Y"),
+                                         datetime.strptime(config['DATA']['TEST_START_DATE'], "%d-%m-%Y"), datetime.strptime(config['DATA']['TEST_END_DATE'], "%d-%m-%Y"),
+                                         chunk_size=int(config['DATA'].get('CHUNK_SIZE', 1_000_000)),
+                                         seed=int(config['DATA'].get('SEED', 42)))
     
-    # Insert to DB
-    df_users.to_sql('UserAssignments', con=engine, if_exists='replace', index=False)
-    df_events.to_sql('EventLogs', con=engine, if_exists='replace', index=False)
+    if config.getboolean('SEQUENTIAL', 'ENABLED', fallback=False):
+        # Sequential test statistics are accumulated from the same chunks which are loaded to DB
+        accumulator = sequential_testing.SequentialAccumulator(datetime.strptime(config['DATA']['TEST_START_DATE'], "%d-%m-%Y"),
+                                                               datetime.strptime(config['DATA']['TEST_END_DATE'], "%d-%m-%Y"))
+        event_chunks = observe_chunks(event_chunks, accumulator, df_users.set_index('user_id')['test_group'])
+
+    if data_exchange.use_event_store(config):
+        # The local event store mirrors EventLogs, so it is replaced together with the tables
+        import event_store
+        store_dir = data_exchange.event_store_dir(config)
+        if if_exists == 'replace' and os.path.exists(store_dir):
+            shutil.rmtree(store_dir)
+        store = event_store.EventStore(store_dir)
+        store.append_assignments(df_users)
+        event_chunks = event_store.store_chunks(event_chunks, store)
+
+    # Insert to DB, event chunks are loaded while next ones are generated
+    load_method = config['DATA'].get('LOAD_METHOD')
+    load_workers = int(config['DATA'].get('LOAD_WORKERS', 4))
+    with instrumentation.span('generate.load'):
+        bulk_loader.load_chunks(engine, 'UserAssignments', [df_users], method=load_method, if_exists=if_exists, max_workers=1)
+        bulk_loader.load_chunks(engine, 'EventLogs', event_chunks, method=load_method, if_exists=if_exists, max_workers=load_workers)
+
+    if config.getboolean('SEQUENTIAL', 'ENABLED', fallback=False):
+        accumulator.save(config.get('SEQUENTIAL', 'STATE_PATH', fallback='.//data//sequential_state.pkl'))
 
     # Populate DailyMetrics table
     print("Data uploaded successfully.")
-    
-    
+    return experiment_id
 
-  
+if __name__ == "__main__":
+    config, engine = data_exchange.connect_to_db()
+    with instrumentation.span('generate'):
+        run(config, engine)
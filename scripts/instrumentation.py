@@ -0,0 +1,316 @@
+import atexit
+import contextlib
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from sqlalchemy import event
+
+# Query and stage tracing, enabled with INSTRUMENTATION.ENABLED in config.ini.
+# Every query goes to the JSON-lines trace with its fingerprint (the statement with literals replaced by ?),
+# execute latency, fetch time, rows and bytes fetched; every span (pipeline stage) with its duration and totals.
+# Totals by fingerprint and stage are written as Prometheus text format for the node_exporter textfile collector.
+# When disabled no hook is installed and span() is a shared no-op context manager.
+
+_tracer = None
+_NO_SPAN = contextlib.nullcontext()
+
+_LITERALS = [
+    (re.compile(r"--[^\n]*|/\*.*?\*/", re.S), ' '),
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), '?'),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), '(?+)'),
+    # Staging tables get a random suffix per call
+    (re.compile(r"\b(\w+Staging)_[0-9a-f]{8}\b"), r'\1_?'),
+    (re.compile(r"\s+"), ' '),
+]
+
+def fingerprint(statement):
+    """(id, normalized statement) of the query shape, the same for every value of its literals"""
+    for pattern, replacement in _LITERALS:
+        statement = pattern.sub(replacement, statement)
+    statement = statement.strip()
+    return hashlib.sha1(statement.encode()).hexdigest()[:12], statement
+
+def _row_bytes(row):
+    return sum(sys.getsizeof(value) for value in row)
+
+class TracedCursor:
+    """DBAPI cursor proxy counting fetched rows and bytes, the query record is written when the cursor is closed
+    or runs the next statement. Bytes are the Python size of the first row of every fetch times its rows.
+    Statements run on the raw DBAPI connection (e.g. the SQLite bulk loader) are traced here,
+    the ones run by SQLAlchemy by the engine events.
+    """
+    def __init__(self, cursor, tracer):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_tracer', tracer)
+        object.__setattr__(self, 'record', None)
+        object.__setattr__(self, 'engine_call', False)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        if name in ('record', 'engine_call'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cursor, name, value)
+
+    def _execute(self, method, statement, *args):
+        engine_call = self.engine_call
+        if not engine_call:
+            self.flush()
+        start = time.perf_counter()
+        try:
+            return getattr(self._cursor, method)(statement, *args)
+        finally:
+            self.engine_call = False
+            if not engine_call:
+                self._tracer.query_finished(self, statement, method == 'executemany', start)
+
+    def execute(self, statement, *args):
+        return self._execute('execute', statement, *args)
+
+    def executemany(self, statement, *args):
+        return self._execute('executemany', statement, *args)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def _count(self, rows, start):
+        if self.record is not None and rows:
+            self.record['rows'] += len(rows)
+            self.record['bytes'] += _row_bytes(rows[0]) * len(rows)
+            self.record['fetch_ms'] += (time.perf_counter() - start) * 1000
+        return rows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count([row], start)
+        return row
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        return self._count(self._cursor.fetchmany(*args), start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        return self._count(self._cursor.fetchall(), start)
+
+    def flush(self):
+        if self.record is not None:
+            self._tracer.write_query(self.record)
+            self.record = None
+
+    def close(self):
+        self.flush()
+        self._cursor.close()
+
+class TracedConnection:
+    """DBAPI connection proxy returning TracedCursor"""
+    def __init__(self, connection, tracer):
+        object.__setattr__(self, '_connection', connection)
+        object.__setattr__(self, '_tracer', tracer)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._connection, name, value)
+
+    def cursor(self, *args, **kwargs):
+        return TracedCursor(self._connection.cursor(*args, **kwargs), self._tracer)
+
+class Tracer:
+    """Writes query and span records to trace_path and the totals to metrics_path.
+
+    Args:
+        trace_path (str): JSON-lines trace, appended to.
+        metrics_path (str): Prometheus text file, rewritten after every span.
+        profile (str): None, 'cprofile' (stats of every span saved to profile_dir/<span>-<time>.prof)
+            or 'tracemalloc' (top allocations of the span in its record, snapshot saved to profile_dir).
+    """
+    def __init__(self, trace_path, metrics_path, profile=None, profile_dir='.//data//profiles'):
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+        self.profile = profile
+        self.profile_dir = profile_dir
+        for path in [trace_path, metrics_path]:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(trace_path, 'a', buffering=1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.queries = {}
+        self.stages = {}
+
+    def current_span(self):
+        spans = getattr(self._local, 'spans', None)
+        return spans[-1] if spans else None
+
+    def _write(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def write_query(self, record):
+        totals_key = record['fingerprint']
+        with self._lock:
+            totals = self.queries.setdefault(totals_key, {'sql': record['sql'], 'count': 0, 'seconds': 0.0,
+                                                          'rows': 0, 'bytes': 0})
+            totals['count'] += 1
+            totals['seconds'] += (record['latency_ms'] + record['fetch_ms']) / 1000
+            totals['rows'] += record['rows']
+            totals['bytes'] += record['bytes']
+            span = record['span']
+            if span in self.stages:
+                self.stages[span]['queries'] += 1
+        self._write(record)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if isinstance(cursor, TracedCursor):
+            cursor.flush()
+            cursor.engine_call = True
+        conn.info['trace_start'] = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.query_finished(cursor, statement, executemany, conn.info.pop('trace_start'))
+
+    def query_finished(self, cursor, statement, executemany, start):
+        latency_ms = (time.perf_counter() - start) * 1000
+        fingerprint_id, normalized = fingerprint(statement)
+        record = {'type': 'query', 'ts': time.time(), 'span': self.current_span(), 'fingerprint': fingerprint_id,
+                  'sql': normalized[:500], 'executemany': executemany, 'latency_ms': latency_ms, 'fetch_ms': 0.0,
+                  'rows': 0, 'bytes': 0}
+        if cursor.description is None:
+            # INSERT, UPDATE, DELETE and MERGE: nothing is fetched, the rows are those written
+            record['rows'] = max(cursor.rowcount, 0)
+            self.write_query(record)
+        elif isinstance(cursor, TracedCursor):
+            cursor.record = record
+        else:
+            self.write_query(record)
+
+    def do_connect(self, dialect, connection_record, cargs, cparams):
+        return TracedConnection(dialect.loaded_dbapi.connect(*cargs, **cparams), self)
+
+    def instrument(self, engine):
+        event.listen(engine, 'do_connect', self.do_connect)
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+        return engine
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        """Times the block, queries run in it by the same thread are attributed to it"""
+        spans = self._local.__dict__.setdefault('spans', [])
+        spans.append(name)
+        with self._lock:
+            stage = self.stages.setdefault(name, {'runs': 0, 'failures': 0, 'seconds': 0.0, 'last_seconds': 0.0,
+                                                  'queries': 0})
+        record = {'type': 'span', 'name': name, 'labels': labels, 'ts': time.time(), 'status': 'done'}
+        profiler = self._start_profile()
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            spans.pop()
+            self._stop_profile(profiler, name, record)
+            with self._lock:
+                stage['runs'] += 1
+                stage['failures'] += record['status'] == 'failed'
+                stage['seconds'] += record['seconds']
+                stage['last_seconds'] = record['seconds']
+            self._write(record)
+            self.write_metrics()
+
+    def _start_profile(self):
+        if self.profile == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        if self.profile == 'tracemalloc':
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            return tracemalloc.take_snapshot()
+        return None
+
+    def _stop_profile(self, profiler, name, record):
+        if profiler is None:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{name}-{int(record['ts'])}")
+        if self.profile == 'cprofile':
+            profiler.disable()
+            profiler.dump_stats(path + '.prof')
+            record['profile'] = path + '.prof'
+        else:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            snapshot.dump(path + '.tracemalloc')
+            record['profile'] = path + '.tracemalloc'
+            record['top_allocations'] = [{'line': str(stat.traceback), 'size_diff': stat.size_diff, 'size': stat.size}
+                                         for stat in snapshot.compare_to(profiler, 'lineno')[:10]]
+
+    def write_metrics(self):
+        """Rewrites the Prometheus text file with the totals so far"""
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+        lines = []
+        with self._lock:
+            queries = {k: dict(v) for k, v in self.queries.items()}
+            stages = {k: dict(v) for k, v in self.stages.items()}
+        for name, kind, key, help_text in [
+                ('abtest_query_total', 'counter', 'count', 'Queries run'),
+                ('abtest_query_seconds_total', 'counter', 'seconds', 'Execute and fetch time of the queries'),
+                ('abtest_query_rows_total', 'counter', 'rows', 'Rows fetched or written'),
+                ('abtest_query_bytes_total', 'counter', 'bytes', 'Estimated bytes fetched (Python size of the rows)')]:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            lines += [f'{name}{{fingerprint="{f}"}} {q[key]}' for f, q in queries.items()]
+        lines += ["# HELP abtest_query_info Normalized statement of the fingerprint", "# TYPE abtest_query_info gauge"]
+        lines += [f'abtest_query_info{{fingerprint="{f}",sql="{escape(q["sql"][:200])}"}} 1' for f, q in queries.items()]
+        for name, kind, key, help_text in [
+                ('abtest_stage_runs_total', 'counter', 'runs', 'Runs of the stage'),
+                ('abtest_stage_failures_total', 'counter', 'failures', 'Failed runs of the stage'),
+                ('abtest_stage_seconds_total', 'counter', 'seconds', 'Time spent in the stage'),
+                ('abtest_stage_last_seconds', 'gauge', 'last_seconds', 'Duration of the last run'),
+                ('abtest_stage_queries_total', 'counter', 'queries', 'Queries run in the stage')]:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            lines += [f'{name}{{stage="{escape(s)}"}} {v[key]}' for s, v in stages.items()]
+        with open(self.metrics_path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(self.metrics_path + '.tmp', self.metrics_path)
+
+    def close(self):
+        self.write_metrics()
+        self._file.close()
+
+def setup(config, engine):
+    """Instruments the engine if INSTRUMENTATION.ENABLED, the tracer is shared by all engines of the process"""
+    global _tracer
+    if not config.getboolean('INSTRUMENTATION', 'ENABLED', fallback=False):
+        return engine
+    if _tracer is None:
+        profile = config.get('INSTRUMENTATION', 'PROFILE', fallback='none').lower()
+        _tracer = Tracer(config.get('INSTRUMENTATION', 'TRACE_PATH', fallback='.//data//trace.jsonl'),
+                         config.get('INSTRUMENTATION', 'METRICS_PATH', fallback='.//data//metrics.prom'),
+                         None if profile == 'none' else profile,
+                         config.get('INSTRUMENTATION', 'PROFILE_DIR', fallback='.//data//profiles'))
+        atexit.register(_tracer.close)
+    return _tracer.instrument(engine)
+
+def span(name, **labels):
+    """Timed span of the active tracer, a no-op when instrumentation is disabled"""
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.span(name, **labels)
@@ -0,0 +1,227 @@
+import pandas as pd
+import numpy as np
+import os
+from datetime import datetime, timedelta
+from functools import lru_cache
+import pyarrow as pa
+import pyarrow.parquet as pq
+import data_exchange
+import event_table
+
+EVENT_TYPES = ['view', 'add_to_basket', 'checkout', 'purchase']
+
+def snapshot_tables(engine, snapshot_dir, chunksize=1_000_000):
+    """Copies EventLogs and UserAssignments once into Parquet files in snapshot_dir.
+    Tables are streamed in chunks, so the snapshot of a large EventLogs does not need to fit in memory.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    for table, columns in [('EventLogs', 'user_id, event_type, event_timestamp, device, revenue'),
+                           ('UserAssignments', 'user_id, experiment_id, test_group, assigned_at')]:
+        path = os.path.join(snapshot_dir, f"{table}.parquet")
+        tmp_path = path + '.tmp'
+        writer = None
+        for df in pd.read_sql(f"SELECT {columns} FROM {table}", con=engine, chunksize=chunksize):
+            if 'revenue' in df:
+                df['revenue'] = df['revenue'].astype(float)
+                df['event_timestamp'] = pd.to_datetime(df['event_timestamp'])
+            chunk = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, chunk.schema)
+            writer.write_table(chunk.cast(writer.schema))
+        if writer is not None:
+            writer.close()
+            os.replace(tmp_path, path)
+    _read_assignments.cache_clear()
+    print(f"Snapshot of EventLogs and UserAssignments saved to {snapshot_dir}.")
+
+def ensure_snapshot(engine, snapshot_dir):
+    if not os.path.exists(os.path.join(snapshot_dir, 'EventLogs.parquet')):
+        snapshot_tables(engine, snapshot_dir)
+
+def _window_end(end_date):
+    # SQL functions use event_timestamp BETWEEN @StartDate AND DATEADD(day, 1, @EndDate)
+    return pd.Timestamp(end_date) + timedelta(days=1)
+
+def read_events(snapshot_dir, start_date, end_date)->pd.DataFrame:
+    """Reads events of the window, row groups outside of the window are skipped by Parquet statistics"""
+    return pd.read_parquet(os.path.join(snapshot_dir, 'EventLogs.parquet'),
+                           filters=[('event_timestamp', '>=', pd.Timestamp(start_date)),
+                                    ('event_timestamp', '<=', _window_end(end_date))])
+
+def read_event_table(snapshot_dir, start_date=None, end_date=None)->event_table.EventTable:
+    """read_events as an EventTable, string columns are read as Parquet dictionaries and kept as codes.
+    Without start_date or end_date the window is open on that side.
+    """
+    filters = []
+    if start_date is not None:
+        filters.append(('event_timestamp', '>=', pd.Timestamp(start_date)))
+    if end_date is not None:
+        filters.append(('event_timestamp', '<=', _window_end(end_date)))
+    table = pq.read_table(os.path.join(snapshot_dir, 'EventLogs.parquet'),
+                          columns=event_table.COLUMNS, read_dictionary=['user_id', 'event_type', 'device'],
+                          filters=filters or None)
+    return event_table.EventTable.from_arrow(table)
+
+def _in_window(events, start_date, end_date):
+    """Events of the window as a DataFrame, an EventTable is filtered on its int64 timestamps first"""
+    if isinstance(events, event_table.EventTable):
+        return events.window(start_date, _window_end(end_date)).to_frame(categorical=True)
+    return events[(events['event_timestamp'] >= pd.Timestamp(start_date)) &
+                  (events['event_timestamp'] <= _window_end(end_date))]
+
+@lru_cache(maxsize=4)
+def _read_assignments(snapshot_dir)->pd.DataFrame:
+    return pd.read_parquet(os.path.join(snapshot_dir, 'UserAssignments.parquet'), columns=['user_id', 'test_group'])
+
+def _join_assignments(events, assignments):
+    """LEFT JOIN EventLogs to UserAssignments on user_id as in the SQL functions.
+    assigned_user_id is NULL for events of unassigned users.
+    """
+    assignments = assignments[['user_id', 'test_group']].assign(assigned_user_id=assignments['user_id'])
+    return events.merge(assignments, on='user_id', how='left')
+
+def get_basic_stat_by_group(events, assignments, start_date, end_date)->pd.DataFrame:
+    """Same output as dbo.GetBasicStatByGroup(start_date, end_date).
+    events is a DataFrame or an EventTable, as in all get_ functions.
+    """
+    events = _in_window(events, start_date, end_date)
+    df = _join_assignments(events, assignments)
+    groups = pd.Index(df['test_group'].drop_duplicates()).sort_values()
+
+    # COUNT(DISTINCT CASE WHEN event_type = ... THEN user_id END) for all event types at once
+    unique_users = (df.dropna(subset=['assigned_user_id'])[['test_group', 'event_type', 'assigned_user_id']]
+                    .drop_duplicates()
+                    .groupby(['test_group', 'event_type'], dropna=False).size()
+                    .unstack(fill_value=0)
+                    .reindex(index=groups, columns=EVENT_TYPES, fill_value=0))
+    purchases = df[df['event_type'] == 'purchase']
+    revenue = purchases['revenue'].fillna(0).groupby(purchases['test_group'], dropna=False).sum().reindex(groups)
+
+    result = pd.DataFrame({
+        'test_group': groups,
+        'view_count': unique_users['view'].to_numpy(),
+        'add_to_basket_count': unique_users['add_to_basket'].to_numpy(),
+        'checkout_count': unique_users['checkout'].to_numpy(),
+        'purchase_count': unique_users['purchase'].to_numpy(),
+    })
+    result['conversion_rate'] = result['purchase_count'] / result['checkout_count'].replace(0, np.nan)
+    # DECIMAL(18,2) revenue divided by INT count has 6 decimal places in SQL Server
+    result['arpu'] = (revenue.round(2).to_numpy() / result['view_count'].replace(0, np.nan)).round(6)
+    return result
+
+def get_total_revenue_by_user(events, assignments, start_date, end_date)->pd.DataFrame:
+    """Same output as dbo.GetTotalRevenueByUser(start_date, end_date)"""
+    events = _in_window(events, start_date, end_date)
+    df = _join_assignments(events, assignments)
+    result = (df['revenue'].fillna(0)
+              .groupby([df['test_group'], df['assigned_user_id']], dropna=False).sum()
+              .round(2)
+              .rename('revenue_sum')
+              .reset_index()
+              .rename(columns={'assigned_user_id': 'user_id'}))
+    return result
+
+def get_revenue_histogram_by_group(events, assignments, start_date, end_date)->pd.DataFrame:
+    """Same output as dbo.GetRevenueHistogramByGroup(start_date, end_date)"""
+    revenue = get_total_revenue_by_user(events, assignments, start_date, end_date)
+    return (revenue.groupby(['test_group', 'revenue_sum'], dropna=False).size()
+            .rename('num_users').reset_index())
+
+def get_user_funnel(events, assignments, start_date, end_date)->pd.DataFrame:
+    """Same output as dbo.GetUserFunnelByUser(start_date, end_date): funnel flags and revenue per assigned user"""
+    events = _in_window(events, start_date, end_date)
+    df = events.merge(assignments[['user_id', 'test_group']], on='user_id', how='inner')
+    flags = df.assign(has_view=df['event_type'] == 'view',
+                      has_checkout=df['event_type'] == 'checkout',
+                      has_purchase=df['event_type'] == 'purchase',
+                      revenue_sum=df['revenue'].fillna(0))
+    result = (flags.groupby(['test_group', 'user_id'], observed=True)
+              .agg(has_view=('has_view', 'max'), has_checkout=('has_checkout', 'max'),
+                   has_purchase=('has_purchase', 'max'), revenue_sum=('revenue_sum', 'sum'))
+              .reset_index())
+    result[['has_view', 'has_checkout', 'has_purchase']] = result[['has_view', 'has_checkout', 'has_purchase']].astype(int)
+    result['revenue_sum'] = result['revenue_sum'].round(2)
+    return result
+
+def get_monthly_user_stats(events, first_month, last_month)->pd.DataFrame:
+    """Same output as vw_MonthlyUserStats WHERE month BETWEEN first_month AND last_month"""
+    if isinstance(events, event_table.EventTable):
+        events = events.to_frame(categorical=True)
+    events = events.assign(month=events['event_timestamp'].dt.month)
+    events = events[events['month'].between(first_month, last_month)]
+    flags = events.assign(has_view=events['event_type'] == 'view',
+                          has_checkout=events['event_type'] == 'checkout',
+                          has_purchase=events['event_type'] == 'purchase',
+                          user_revenue=events['revenue'].where(events['event_type'] == 'purchase', 0).fillna(0))
+    result = (flags.groupby(['month', 'user_id'], observed=True)
+              .agg(has_view=('has_view', 'max'), has_checkout=('has_checkout', 'max'),
+                   has_purchase=('has_purchase', 'max'), user_revenue=('user_revenue', 'sum'))
+              .reset_index())
+    result[['has_view', 'has_checkout', 'has_purchase']] = result[['has_view', 'has_checkout', 'has_purchase']].astype(int)
+    return result
+
+def get_segment_stats(events, assignments, start_date, end_date, segments=('device', 'date', 'user_type'))->pd.DataFrame:
+    """Per-user CR and ARPU statistics by experiment, segment and test group.
+
+    Segments are device, date of the event and user_type ('new' or 'returning': the user has events before start_date).
+    events must include history before start_date to tell returning users.
+    Returns one row per (experiment_id, segment, segment_value, test_group) with checkout and purchase
+    user counts for CR and number of viewers, mean and variance of per-viewer revenue for ARPU.
+    """
+    start, end = pd.Timestamp(start_date), _window_end(end_date)
+    if isinstance(events, event_table.EventTable):
+        events = events.to_frame(categorical=True)
+    returning_users = events.loc[events['event_timestamp'] < start, 'user_id'].unique()
+    events = events[(events['event_timestamp'] >= start) & (events['event_timestamp'] <= end)]
+    df = events.merge(assignments[['user_id', 'experiment_id', 'test_group']], on='user_id', how='inner')
+    df['date'] = df['event_timestamp'].dt.strftime('%Y-%m-%d')
+    df['user_type'] = np.where(df['user_id'].isin(returning_users), 'returning', 'new')
+    df['revenue'] = df['revenue'].fillna(0)
+    for event_type in ['view', 'checkout', 'purchase']:
+        df[f'is_{event_type}'] = df['event_type'] == event_type
+
+    stats = []
+    for segment in segments:
+        keys = ['experiment_id', segment, 'test_group']
+        users = (df.groupby(keys + ['user_id'], observed=True)
+                 .agg(has_view=('is_view', 'max'), has_checkout=('is_checkout', 'max'),
+                      has_purchase=('is_purchase', 'max'), revenue=('revenue', 'sum'))
+                 .reset_index())
+        checkout_users = users[users['has_checkout']]
+        cr = checkout_users.groupby(keys).agg(checkout_count=('user_id', 'size'), purchase_count=('has_purchase', 'sum'))
+        viewers = users[users['has_view']]
+        arpu = viewers.groupby(keys)['revenue'].agg(view_count='size', arpu='mean', revenue_var='var')
+        segment_stats = cr.join(arpu, how='outer').reset_index().rename(columns={segment: 'segment_value'})
+        segment_stats.insert(1, 'segment', segment)
+        stats.append(segment_stats)
+    return pd.concat(stats, ignore_index=True)
+
+def basic_stat_by_group(snapshot_dir, start_date, end_date)->pd.DataFrame:
+    return get_basic_stat_by_group(read_event_table(snapshot_dir, start_date, end_date),
+                                   _read_assignments(snapshot_dir), start_date, end_date)
+
+def total_revenue_by_user(snapshot_dir, start_date, end_date)->pd.DataFrame:
+    return get_total_revenue_by_user(read_event_table(snapshot_dir, start_date, end_date),
+                                     _read_assignments(snapshot_dir), start_date, end_date)
+
+def revenue_histogram_by_group(snapshot_dir, start_date, end_date)->pd.DataFrame:
+    return get_revenue_histogram_by_group(read_event_table(snapshot_dir, start_date, end_date),
+                                          _read_assignments(snapshot_dir), start_date, end_date)
+
+def user_funnel(snapshot_dir, start_date, end_date)->pd.DataFrame:
+    return get_user_funnel(read_event_table(snapshot_dir, start_date, end_date),
+                           _read_assignments(snapshot_dir), start_date, end_date)
+
+def monthly_user_stats(snapshot_dir, first_month, last_month)->pd.DataFrame:
+    return get_monthly_user_stats(read_event_table(snapshot_dir), first_month, last_month)
+
+def segment_stats(snapshot_dir, start_date, end_date)->pd.DataFrame:
+    events = read_event_table(snapshot_dir, end_date=end_date)
+    assignments = pd.read_parquet(os.path.join(snapshot_dir, 'UserAssignments.parquet'),
+                                  columns=['user_id', 'experiment_id', 'test_group'])
+    return get_segment_stats(events, assignments, start_date, end_date)
+
+if __name__ == "__main__":
+    # Refresh the local snapshot after new data was loaded
+    config, engine = data_exchange.connect_to_db()
+    snapshot_tables(engine, data_exchange.snapshot_dir(config))
@@ -1,3 +1,4 @@
+import numpy as np
 import scipy as sp
 
 def proportions_z_test(p1, p2, n1, n2):
@@ -28,3 +29,134 @@ def check_srm(num_a, num_b, expected_ratio_a=0.5):
     chi2_stat, p_value = sp.stats.chisquare(f_obs=observed, f_exp=expected)
     
     return p_value
+
+def proportions_z_test_batch(p1, p2, n1, n2):
+    """Vectorized proportions_z_test over arrays of group statistics.
+
+    Returns: arrays of z-scores and two-sided p-values.
+    """
+    p1, p2, n1, n2 = (np.asarray(x, dtype=float) for x in (p1, p2, n1, n2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ese = np.sqrt(p1*(1-p1)/n1 + p2*(1-p2)/n2)
+        z = (p1-p2)/ese
+    p = sp.stats.norm.sf(np.abs(z)) * 2
+    return z, p
+
+def welch_t_test_batch(mean1, var1, n1, mean2, var2, n2):
+    """Vectorized Welch t-test for the difference of means from group statistics.
+
+    Returns: arrays of t-statistics and two-sided p-values.
+    """
+    mean1, var1, n1, mean2, var2, n2 = (np.asarray(x, dtype=float) for x in (mean1, var1, n1, mean2, var2, n2))
+    se1, se2 = var1/n1, var2/n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (mean1-mean2)/np.sqrt(se1+se2)
+        df = (se1+se2)**2 / (se1**2/(n1-1) + se2**2/(n2-1))
+    p = sp.stats.t.sf(np.abs(t), df) * 2
+    return t, p
+
+def adjust_p_values(p_values, method='holm'):
+    """Multiple-testing adjusted p-values: 'bonferroni', 'holm' (FWER) or 'bh' (Benjamini-Hochberg FDR).
+    NaN p-values are kept as NaN and are not counted as tests.
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    adjusted = np.full_like(p_values, np.nan)
+    valid = ~np.isnan(p_values)
+    p = p_values[valid]
+    m = len(p)
+    if m == 0:
+        return adjusted
+    order = np.argsort(p)
+    ranked = p[order]
+    if method == 'bonferroni':
+        ranked_adj = ranked * m
+    elif method == 'holm':
+        ranked_adj = np.maximum.accumulate(ranked * (m - np.arange(m)))
+    elif method == 'bh':
+        ranked_adj = np.minimum.accumulate((ranked * m / np.arange(1, m+1))[::-1])[::-1]
+    else:
+        raise ValueError(f"Unknown multiple testing method {method}")
+    p_adj = np.empty(m)
+    p_adj[order] = np.minimum(ranked_adj, 1)
+    adjusted[valid] = p_adj
+    return adjusted
+
+def batch_test_cells(cells, alpha=0.05, method='holm'):
+    """Tests all metric cells in one vectorized pass.
+
+    Args:
+        cells (pd.DataFrame): One row per metric cell with metric_type ('proportion' or 'mean'),
+            control_value, variant_value, sample_size_a, sample_size_b
+            and var_a, var_b for 'mean' cells.
+        alpha (float): Significance level after the correction.
+        method (str): Multiple testing correction, see adjust_p_values.
+
+    Returns: copy of cells with statistic, p_value, p_value_adjusted, lift and is_significant columns.
+    """
+    cells = cells.copy()
+    is_mean = (cells['metric_type'] == 'mean').to_numpy()
+    z, p = proportions_z_test_batch(cells['control_value'], cells['variant_value'],
+                                    cells['sample_size_a'], cells['sample_size_b'])
+    if is_mean.any():
+        t, p_t = welch_t_test_batch(cells['control_value'], cells['var_a'], cells['sample_size_a'],
+                                    cells['variant_value'], cells['var_b'], cells['sample_size_b'])
+        z = np.where(is_mean, t, z)
+        p = np.where(is_mean, p_t, p)
+    cells['statistic'] = z
+    cells['p_value'] = p
+    cells['p_value_adjusted'] = adjust_p_values(p, method)
+    control = cells['control_value'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cells['lift'] = np.where(control != 0, (cells['variant_value'].to_numpy(dtype=float) - control) / control, 0)
+    cells['is_significant'] = (cells['p_value_adjusted'] < alpha).astype(int)
+    return cells
+
+def value_counts(values, decimals=2):
+    """Compressed representation of values: sorted distinct values (rounded to cents) and their counts"""
+    return np.unique(np.round(np.asarray(values, dtype=float), decimals), return_counts=True)
+
+def mannwhitneyu_compressed(values_a, counts_a, values_b, counts_b, alternative='two-sided'):
+    """Tie-corrected Mann-Whitney U test on value counts instead of raw samples.
+
+    Gives the same result as scipy.stats.mannwhitneyu(method='asymptotic') with continuity correction
+    on the expanded samples, but memory and time depend on the number of distinct values only.
+    Zero-inflated revenue is a single (0, number of users without purchase) entry.
+
+    Args:
+        values_a, counts_a: Distinct values of group A and number of users with each value.
+        values_b, counts_b: Same for group B.
+        alternative (str): 'two-sided', 'less' or 'greater'.
+
+    Returns: U statistic of group A and p-value.
+    """
+    values_a, values_b = np.asarray(values_a, dtype=float), np.asarray(values_b, dtype=float)
+    values = np.union1d(values_a, values_b)
+    count_a = np.zeros(len(values))
+    count_b = np.zeros(len(values))
+    np.add.at(count_a, np.searchsorted(values, values_a), np.asarray(counts_a, dtype=float))
+    np.add.at(count_b, np.searchsorted(values, values_b), np.asarray(counts_b, dtype=float))
+
+    ties = count_a + count_b
+    n1, n2 = count_a.sum(), count_b.sum()
+    n = n1 + n2
+    # All users with the same value share the mid-rank of their block
+    midranks = np.cumsum(ties) - (ties - 1) / 2
+    u1 = np.sum(count_a * midranks) - n1 * (n1 + 1) / 2
+    u2 = n1 * n2 - u1
+
+    mu = n1 * n2 / 2
+    tie_term = np.sum(ties**3 - ties)
+    s = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    if alternative == 'two-sided':
+        u = max(u1, u2)
+    elif alternative == 'greater':
+        u = u1
+    elif alternative == 'less':
+        u = u2
+    else:
+        raise ValueError(f"Unknown alternative {alternative}")
+    z = (u - mu - 0.5) / s
+    p = sp.stats.norm.sf(z)
+    if alternative == 'two-sided':
+        p = min(1.0, 2 * p)
+    return u1, p
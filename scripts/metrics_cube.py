@@ -0,0 +1,176 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+from sqlalchemy import text
+from sketches import hash_user_ids, register_updates, estimate_counts
+
+EVENT_TYPES = ['view', 'add_to_basket', 'checkout', 'purchase']
+DEVICES = ['mobile', 'desktop', 'tablet']
+DIMENSIONS = ['date', 'test_group', 'device', 'event_type']
+
+# Events of one experiment with the test group of their user, streamed in chunks to build the cube
+EXPERIMENT_EVENTS_SQL = """
+            SELECT e.user_id, e.event_type, e.event_timestamp, e.device, e.revenue, u.test_group
+            FROM EventLogs AS e
+            JOIN UserAssignments AS u ON e.user_id = u.user_id
+            WHERE e.event_timestamp IS NOT NULL
+              AND u.experiment_id = :experiment_id
+"""
+
+class MetricsCube:
+    """Daily event counts, revenue and distinct-user sketches by (date, test_group, device, event_type)
+    of one experiment.
+
+    Counts and revenue keep prefix sums over dates, so totals of any date window are the difference
+    of two prefix rows. Distinct users of a cell are HyperLogLog registers (2**precision bytes), the users
+    of a window or of several cells are the element-wise max of their registers.
+    The date axis grows when events outside of it arrive, other axes are fixed and
+    events with other groups, devices or event types are ignored.
+    """
+    def __init__(self, experiment_id, start_date=None, num_days=0, groups=('A', 'B'), devices=DEVICES,
+                 event_types=EVENT_TYPES, precision=12):
+        self.experiment_id = experiment_id
+        self.start_date = None if start_date is None else pd.Timestamp(start_date).normalize()
+        self.axes = {'test_group': list(groups), 'device': list(devices), 'event_type': list(event_types)}
+        self.precision = precision
+        shape = (num_days, len(groups), len(devices), len(event_types))
+        self.event_count = np.zeros(shape, dtype=np.int64)
+        self.revenue = np.zeros(shape)
+        self.registers = np.zeros(shape + (1 << precision,), dtype=np.uint8)
+        self._prefix = None
+
+    @property
+    def dates(self)->pd.DatetimeIndex:
+        if self.start_date is None:
+            return pd.DatetimeIndex([])
+        return pd.date_range(self.start_date, periods=len(self.event_count), freq='D')
+
+    def _extend_dates(self, first_date, last_date):
+        """Pads the date axis so that it covers [first_date, last_date]"""
+        if self.start_date is None:
+            self.start_date = first_date
+        before = max(0, (self.start_date - first_date).days)
+        after = max(0, (last_date - self.start_date).days + 1 - len(self.event_count))
+        if before or after:
+            pad = lambda a: np.pad(a, [(before, after)] + [(0, 0)] * (a.ndim - 1))
+            self.event_count, self.revenue, self.registers = pad(self.event_count), pad(self.revenue), pad(self.registers)
+            self.start_date -= pd.Timedelta(days=before)
+
+    def update(self, events, test_groups=None):
+        """Adds a chunk of events.
+
+        Args:
+            events (pd.DataFrame): EventLogs rows with user_id, event_type, event_timestamp, device and revenue,
+                and test_group if test_groups is None.
+            test_groups (pd.Series): test_group indexed by user_id.
+        """
+        if test_groups is not None:
+            events = events.assign(test_group=events['user_id'].map(test_groups))
+        dates = pd.to_datetime(events['event_timestamp']).dt.normalize()
+        events = events[dates.notna()]
+        dates = dates[dates.notna()]
+        if events.empty:
+            return self
+        self._extend_dates(dates.min(), dates.max())
+        index = [((dates - self.start_date).dt.days).to_numpy()]
+        index += [pd.Index(values).get_indexer(events[dim]) for dim, values in self.axes.items()]
+        is_known = np.logical_and.reduce([i >= 0 for i in index])
+        cells = np.ravel_multi_index([i[is_known] for i in index], self.event_count.shape)
+        size = self.event_count.size
+        self.event_count += np.bincount(cells, minlength=size).reshape(self.event_count.shape)
+        revenue = events['revenue'].to_numpy(dtype=float)[is_known]
+        self.revenue += np.bincount(cells, weights=np.nan_to_num(revenue), minlength=size).reshape(self.revenue.shape)
+        idx, rho = register_updates(hash_user_ids(events['user_id'].to_numpy()[is_known]), self.precision)
+        np.maximum.at(self.registers.reshape(size, -1), (cells, idx), rho)
+        self._prefix = None
+        return self
+
+    def _prefix_sums(self):
+        """Cumulative counts and revenue over dates with a leading zero row: window [i, j) = prefix[j] - prefix[i]"""
+        if self._prefix is None:
+            self._prefix = tuple(np.concatenate([np.zeros((1,) + a.shape[1:], dtype=a.dtype), np.cumsum(a, axis=0)])
+                                 for a in (self.event_count, self.revenue))
+        return self._prefix
+
+    def _day_range(self, start_date, end_date):
+        num_days = len(self.event_count)
+        if self.start_date is None:
+            return 0, 0
+        i = 0 if start_date is None else (pd.Timestamp(start_date).normalize() - self.start_date).days
+        j = num_days if end_date is None else (pd.Timestamp(end_date).normalize() - self.start_date).days + 1
+        return min(max(i, 0), num_days), min(max(j, 0), num_days)
+
+    def _to_frame(self, by, event_count, revenue, registers, index_arrays):
+        """Flattens arrays over the by axes into rows"""
+        grid = pd.MultiIndex.from_product(index_arrays, names=by).to_frame(index=False)
+        grid['event_count'] = event_count.reshape(-1)
+        grid['unique_users'] = np.round(estimate_counts(registers.reshape(len(grid), -1))).astype(np.int64)
+        grid['total_revenue'] = revenue.reshape(-1).round(2)
+        return grid
+
+    def totals(self, start_date=None, end_date=None, by=('test_group', 'event_type'))->pd.DataFrame:
+        """Event count, distinct users and revenue of the [start_date, end_date] window by the by dimensions.
+        Counts and revenue are two prefix rows, the distinct users merge the sketches of the window days.
+        """
+        by = [dim for dim in DIMENSIONS[1:] if dim in by]
+        i, j = self._day_range(start_date, end_date)
+        count_prefix, revenue_prefix = self._prefix_sums()
+        other = tuple(k for k, dim in enumerate(DIMENSIONS[1:]) if dim not in by)
+        event_count = (count_prefix[j] - count_prefix[i]).sum(axis=other)
+        revenue = (revenue_prefix[j] - revenue_prefix[i]).sum(axis=other)
+        registers = self.registers[i:j].max(axis=0, initial=0).max(axis=other, initial=0)
+        return self._to_frame(by, event_count, revenue, registers, [self.axes[dim] for dim in by])
+
+    def daily(self, start_date=None, end_date=None, by=('test_group', 'event_type'))->pd.DataFrame:
+        """DailyMetrics-like rows: per date event count, distinct users and revenue by the by dimensions"""
+        by = [dim for dim in DIMENSIONS[1:] if dim in by]
+        i, j = self._day_range(start_date, end_date)
+        other = tuple(k + 1 for k, dim in enumerate(DIMENSIONS[1:]) if dim not in by)
+        event_count = self.event_count[i:j].sum(axis=other)
+        revenue = self.revenue[i:j].sum(axis=other)
+        registers = self.registers[i:j].max(axis=other, initial=0)
+        return self._to_frame(['date'] + by, event_count, revenue, registers,
+                              [self.dates[i:j]] + [self.axes[dim] for dim in by])
+
+    def basic_stat_by_group(self, start_date=None, end_date=None)->pd.DataFrame:
+        """Same columns as dbo.GetBasicStatByGroup(start_date, end_date), distinct counts are sketch estimates"""
+        totals = self.totals(start_date, end_date, by=('test_group', 'event_type'))
+        unique_users = totals.pivot(index='test_group', columns='event_type', values='unique_users')
+        revenue = totals[totals['event_type'] == 'purchase'].set_index('test_group')['total_revenue']
+        result = pd.DataFrame({f"{event_type}_count": unique_users[event_type] for event_type in EVENT_TYPES})
+        result['conversion_rate'] = result['purchase_count'] / result['checkout_count'].replace(0, np.nan)
+        result['arpu'] = (revenue / result['view_count'].replace(0, np.nan)).round(6)
+        return result.rename_axis(None, axis='columns').reset_index()
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        meta = {'experiment_id': self.experiment_id, 'precision': self.precision, 'axes': self.axes,
+                'start_date': None if self.start_date is None else self.start_date.strftime("%Y-%m-%d")}
+        np.savez_compressed(path, event_count=self.event_count, revenue=self.revenue,
+                            registers=self.registers, meta=json.dumps(meta))
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            cube = MetricsCube(meta['experiment_id'], meta['start_date'], 0, meta['axes']['test_group'],
+                               meta['axes']['device'], meta['axes']['event_type'], meta['precision'])
+            cube.event_count, cube.revenue, cube.registers = data['event_count'], data['revenue'], data['registers']
+        return cube
+
+def build_from_engine(engine, experiment_id, chunksize=1_000_000, **options)->MetricsCube:
+    """Builds the cube of the experiment with one pass over EventLogs"""
+    cube = MetricsCube(experiment_id, **options)
+    with engine.connect() as conn:
+        for chunk in pd.read_sql(text(EXPERIMENT_EVENTS_SQL), con=conn, params={'experiment_id': experiment_id},
+                                 chunksize=chunksize):
+            cube.update(chunk)
+    return cube
+
+def build_from_snapshot(snapshot_dir, experiment_id, start_date=None, end_date=None, **options)->MetricsCube:
+    """Builds the cube from the local columnar snapshot, which holds the assignments of one experiment"""
+    import local_engine
+    events = local_engine.read_events(snapshot_dir, start_date or '1900-01-01', end_date or '2999-12-31')
+    assignments = local_engine._read_assignments(snapshot_dir)
+    return MetricsCube(experiment_id, **options).update(events, assignments.set_index('user_id')['test_group'])
@@ -0,0 +1,79 @@
+import pandas as pd
+import numpy as np
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import scipy as sp
+import local_statistics as local_stat
+
+# Per-worker history samples, set once by the pool initializer
+_history = None
+
+def _init_worker(history):
+    global _history
+    _history = history
+
+def simulate_p_values(metric, mde, sample_size, num_replicates, seed, max_cells=2_000_000):
+    """p-values of the experiment test on num_replicates simulated experiments with the relative effect mde.
+
+    Both groups are resampled from history, group B gets the effect:
+    ARPU - revenue is multiplied by (1 + mde) and compared with the Mann-Whitney U-test as in analyse_experiment_data,
+    CR - non-converted users convert with the probability which lifts CR by mde, compared with the proportions z-test.
+    """
+    rng = np.random.default_rng(seed)
+    values = _history[metric]
+    p_values = []
+    batch = max(1, max_cells // sample_size)
+    for start in range(0, num_replicates, batch):
+        num = min(batch, num_replicates - start)
+        a = rng.choice(values, size=(num, sample_size))
+        b = rng.choice(values, size=(num, sample_size))
+        if metric == 'ARPU':
+            p = sp.stats.mannwhitneyu(a, b * (1 + mde), alternative='two-sided', axis=1).pvalue
+        else:
+            base_cr = values.mean()
+            convert_prob = base_cr * mde / (1 - base_cr)
+            b = np.maximum(b, rng.random(b.shape) < convert_prob)
+            _, p = local_stat.proportions_z_test_batch(a.mean(axis=1), b.mean(axis=1), sample_size, sample_size)
+        p_values.append(p)
+    return np.concatenate(p_values)
+
+def _simulate_cell(cell):
+    metric, mde, sample_size, alphas, num_replicates, seed = cell
+    p_values = simulate_p_values(metric, mde, sample_size, num_replicates, seed)
+    return [(metric, mde, sample_size, alpha, np.mean(p_values < alpha), num_replicates) for alpha in alphas]
+
+def history_samples(df_user_stats):
+    """Per-user history values: revenue of viewers for ARPU, purchase indicator of checkout users for CR"""
+    return {
+        'ARPU': df_user_stats.loc[df_user_stats['has_view'] == 1, 'user_revenue'].to_numpy(dtype=float),
+        'CR': df_user_stats.loc[df_user_stats['has_checkout'] == 1, 'has_purchase'].to_numpy(dtype=float)
+    }
+
+def power_surface(df_user_stats, grid, alphas, num_replicates=500, max_workers=None, seed=42)->pd.DataFrame:
+    """Monte Carlo power for every (metric, MDE, sample size, alpha) on resampled history.
+
+    Args:
+        df_user_stats (pd.DataFrame): Rows of vw_MonthlyUserStats for the history window.
+        grid (dict): metric -> (list of relative MDEs, list of sample sizes per group).
+        alphas (list): Significance levels, evaluated on the same simulated p-values.
+        num_replicates (int): Simulated experiments per (metric, MDE, sample size).
+        max_workers (int): Processes in the pool, all cores if None.
+
+    Returns: DataFrame with metric, mde, sample_size, alpha, power and num_replicates columns.
+    """
+    cells = [(metric, mde, int(n), tuple(alphas), num_replicates)
+             for metric, (mdes, sample_sizes) in grid.items() for mde in mdes for n in sample_sizes]
+    seeds = np.random.SeedSequence(seed).spawn(len(cells))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(history_samples(df_user_stats),)) as executor:
+        rows = executor.map(_simulate_cell, [cell + (s,) for cell, s in zip(cells, seeds)])
+        rows = [row for cell_rows in rows for row in cell_rows]
+    return pd.DataFrame(rows, columns=['metric', 'mde', 'sample_size', 'alpha', 'power', 'num_replicates'])
+
+def cached_power_surface(cache, df_user_stats, first_month, last_month, grid, alphas, num_replicates=500, max_workers=None):
+    """power_surface which is recomputed only when the history data or the grid change"""
+    data_hash = hashlib.sha1(pd.util.hash_pandas_object(df_user_stats, index=False).to_numpy().tobytes()).hexdigest()
+    data_version = (data_hash, sorted(grid.items()), list(alphas), num_replicates)
+    return cache.get_or_compute('power_surface', first_month, last_month, data_version,
+                                lambda: power_surface(df_user_stats, grid, alphas, num_replicates, max_workers))
@@ -0,0 +1,85 @@
+import pandas as pd
+import os
+import glob
+import hashlib
+import json
+import threading
+
+class QueryCache:
+    """Disk cache of query results shared by the pipeline scripts.
+
+    Entries are keyed by query name, date range and data version and stored as gzip-compressed pickles.
+    When the data version changes, older entries of the same query and range are dropped.
+    The least recently used entries are evicted when the cache grows over max_bytes.
+    Hit/miss/eviction counters are kept in stats.json, so they add up across scripts.
+    """
+    def __init__(self, cache_dir, max_bytes=512 * 2**20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _digest(*parts):
+        return hashlib.sha1('|'.join(str(p) for p in parts).encode()).hexdigest()[:20]
+
+    def _path(self, query_name, start_date, end_date, data_version):
+        return os.path.join(self.cache_dir,
+                            f"{self._digest(query_name, start_date, end_date)}-{self._digest(data_version)}.pkl.gz")
+
+    def _count(self, counter):
+        stats_path = os.path.join(self.cache_dir, 'stats.json')
+        with self._lock:
+            stats = self.stats()
+            stats[counter] += 1
+            with open(stats_path, 'w') as f:
+                json.dump(stats, f)
+
+    def stats(self):
+        stats_path = os.path.join(self.cache_dir, 'stats.json')
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        if os.path.exists(stats_path):
+            with open(stats_path) as f:
+                stats.update(json.load(f))
+        return stats
+
+    def get(self, query_name, start_date, end_date, data_version):
+        path = self._path(query_name, start_date, end_date, data_version)
+        try:
+            df = pd.read_pickle(path, compression='gzip')
+        except (FileNotFoundError, EOFError):
+            self._count('misses')
+            return None
+        # Access time for LRU, atime is not reliable on all file systems
+        os.utime(path)
+        self._count('hits')
+        return df
+
+    def put(self, query_name, start_date, end_date, data_version, df):
+        path = self._path(query_name, start_date, end_date, data_version)
+        # Entries of the same query with an older data version are stale
+        prefix = path.rsplit('-', 1)[0]
+        for stale_path in glob.glob(prefix + '-*.pkl.gz'):
+            os.remove(stale_path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        df.to_pickle(tmp_path, compression='gzip')
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits into max_bytes"""
+        entries = [(os.path.getmtime(p), os.path.getsize(p), p) for p in glob.glob(os.path.join(self.cache_dir, '*.pkl.gz'))]
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+            self._count('evictions')
+
+    def get_or_compute(self, query_name, start_date, end_date, data_version, compute):
+        df = self.get(query_name, start_date, end_date, data_version)
+        if df is None:
+            df = compute()
+            self.put(query_name, start_date, end_date, data_version, df)
+        return df
@@ -0,0 +1,175 @@
+import pandas as pd
+import argparse
+import configparser
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import data_exchange
+import instrumentation
+import generate_ecomm_data
+import validate_experiment
+import fix_sample_size
+import collect_experiment_data
+import analyse_experiment_data
+
+# Stage -> stages it depends on. validate, size and collect of one experiment run concurrently.
+STAGES = {
+    'generate': [],
+    'validate': ['generate'],
+    'size': ['generate'],
+    'collect': ['generate'],
+    'analyse': ['validate', 'collect'],
+}
+
+# generate reads the new experiment_id with MAX(experiment_id), so it runs for one experiment at a time
+_stage_locks = {'generate': threading.Lock()}
+
+# Re-running generate after a partial failure would insert a second experiment
+RETRYABLE_STAGES = {'validate', 'size', 'collect', 'analyse'}
+
+class Job:
+    """One experiment going through the pipeline stages"""
+    def __init__(self, label, config, experiment_id=None, assets_dir='.//assets'):
+        self.label = label
+        self.config = config
+        self.experiment_id = experiment_id
+        self.assets_dir = assets_dir
+        self.status = {}
+
+def job_config(config, label):
+    """Copy of config with a per-experiment sequential state file"""
+    copy = configparser.ConfigParser()
+    copy.read_dict({section: dict(config.items(section, raw=True)) for section in config.sections()})
+    if copy.has_section('SEQUENTIAL'):
+        state_path = copy.get('SEQUENTIAL', 'STATE_PATH', fallback='.//data//sequential_state.pkl')
+        root, ext = os.path.splitext(state_path)
+        copy['SEQUENTIAL']['STATE_PATH'] = f"{root}_{label}{ext}"
+    return copy
+
+def run_stage(stage, job, engine):
+    if stage == 'generate':
+        job.experiment_id = generate_ecomm_data.run(job.config, engine, if_exists='append')
+    elif stage == 'validate':
+        validate_experiment.run(job.config, engine)
+    elif stage == 'size':
+        fix_sample_size.run(job.config, engine, job.assets_dir)
+    elif stage == 'collect':
+        collect_experiment_data.run(job.config, engine, job.experiment_id, job.assets_dir)
+    elif stage == 'analyse':
+        analyse_experiment_data.run(job.config, engine, job.experiment_id)
+
+def run_with_retries(stage, job, engine, retries, backoff):
+    """Runs the stage, retrying failures with exponential backoff. Returns (status, attempts, seconds, error)."""
+    attempts = 1 + (retries if stage in RETRYABLE_STAGES else 0)
+    start = time.perf_counter()
+    for attempt in range(1, attempts + 1):
+        try:
+            lock = _stage_locks.get(stage)
+            with instrumentation.span(stage, experiment=job.label, attempt=attempt):
+                if lock is None:
+                    run_stage(stage, job, engine)
+                else:
+                    with lock:
+                        run_stage(stage, job, engine)
+            return 'done', attempt, time.perf_counter() - start, None
+        except Exception as e:
+            print(f"[{job.label}] {stage} failed on attempt {attempt}/{attempts}: {e!r}")
+            if attempt < attempts:
+                time.sleep(backoff * 2**(attempt - 1))
+            error = e
+    return 'failed', attempts, time.perf_counter() - start, repr(error)
+
+def run_pipeline(engine, jobs, max_workers=4, retries=2, backoff=1.0)->pd.DataFrame:
+    """Runs the stages of all jobs on a shared engine, every stage as soon as its dependencies are done.
+
+    Args:
+        engine: SQLAlchemy engine with a connection pool of at least max_workers connections.
+        jobs (list): Jobs, those with experiment_id set skip the generate stage.
+        max_workers (int): Stages running at the same time over all experiments.
+        retries (int): Extra attempts of a failed stage, generate is never retried.
+        backoff (float): Seconds before the first retry, doubled after every attempt.
+
+    Returns: DataFrame with experiment, stage, status, attempts, seconds (including waits for the stage lock
+    and retries), started, finished and error per stage.
+    Stages depending on a failed stage are reported as skipped.
+    """
+    for job in jobs:
+        if job.experiment_id is not None:
+            job.status['generate'] = 'done'
+    report = []
+    pipeline_start = time.perf_counter()
+
+    def ready_stages():
+        for job in jobs:
+            for stage, deps in STAGES.items():
+                if stage in job.status:
+                    continue
+                dep_status = [job.status.get(dep) for dep in deps]
+                if any(s in ('failed', 'skipped') for s in dep_status):
+                    job.status[stage] = 'skipped'
+                    report.append({'experiment': job.label, 'stage': stage, 'status': 'skipped', 'attempts': 0})
+                elif all(s == 'done' for s in dep_status):
+                    yield job, stage
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while True:
+            for job, stage in list(ready_stages()):
+                job.status[stage] = 'running'
+                started = time.perf_counter() - pipeline_start
+                future = executor.submit(run_with_retries, stage, job, engine, retries, backoff)
+                running[future] = (job, stage, started)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, stage, started = running.pop(future)
+                status, attempts, seconds, error = future.result()
+                job.status[stage] = status
+                print(f"[{job.label}] {stage} {status} in {seconds:.1f}s")
+                report.append({'experiment': job.label, 'stage': stage, 'status': status, 'attempts': attempts,
+                               'seconds': seconds, 'started': started, 'finished': started + seconds, 'error': error})
+    return pd.DataFrame(report, columns=['experiment', 'stage', 'status', 'attempts', 'seconds', 'started', 'finished', 'error'])
+
+def print_report(report):
+    stages = report.pivot_table(index='experiment', columns='stage', values='seconds', aggfunc='first')
+    stages = stages.reindex(columns=[s for s in STAGES if s in stages.columns])
+    stages['wall_clock'] = report.groupby('experiment')['finished'].max() - report.groupby('experiment')['started'].min()
+    print("\nSeconds by experiment and stage:")
+    print(stages.round(1).to_string())
+    failed = report[report['status'] != 'done']
+    if not failed.empty:
+        print("\nNot completed:")
+        print(failed[['experiment', 'stage', 'status', 'error']].to_string(index=False))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs validate, size, collect and analyse for several experiments concurrently")
+    parser.add_argument('--experiments', type=int, nargs='*', default=[],
+                        help="ids of existing experiments")
+    parser.add_argument('--new', type=int, default=0,
+                        help="number of new experiments to generate (appended to UserAssignments and EventLogs)")
+    parser.add_argument('--workers', type=int, default=4, help="stages running at the same time")
+    parser.add_argument('--retries', type=int, default=2, help="extra attempts of a failed stage")
+    parser.add_argument('--backoff', type=float, default=1.0, help="seconds before the first retry")
+    parser.add_argument('--report', help="path of the CSV with per-stage timings")
+    args = parser.parse_args()
+
+    # One pooled engine for all stages: a connection per worker plus headroom for the parallel loaders
+    config, engine = data_exchange.connect_to_db(pool_size=args.workers, max_overflow=args.workers)
+    labels = [str(e) for e in args.experiments] + [f"new{i + 1}" for i in range(args.new)]
+    if not labels:
+        parser.error("set --experiments and/or --new")
+    # Outputs of several experiments go to assets/<experiment>, a single experiment keeps assets/
+    single = len(labels) == 1
+    jobs = [Job(label, job_config(config, label),
+                int(label) if i < len(args.experiments) else None,
+                './/assets' if single else os.path.join('.//assets', label))
+            for i, label in enumerate(labels)]
+
+    start = time.perf_counter()
+    report = run_pipeline(engine, jobs, args.workers, args.retries, args.backoff)
+    print_report(report)
+    print(f"\nPipeline finished in {time.perf_counter() - start:.1f}s")
+    if args.report:
+        report.to_csv(args.report, float_format="%.3f", index=False, mode='w')
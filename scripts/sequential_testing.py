@@ -0,0 +1,141 @@
+import pandas as pd
+import numpy as np
+import pickle
+import os
+from sketches import HyperLogLog
+
+def msprt_p_value(diff, var, tau2):
+    """p-value of the mixture SPRT for H0: diff = 0 with a N(0, tau2) mixture over the effect.
+
+    Args:
+        diff (float): Observed difference of group means (B - A).
+        var (float): Variance of the difference, e.g. var_a/n_a + var_b/n_b.
+        tau2 (float): Variance of the mixing distribution, the scale of effects we expect.
+
+    Returns: 1 / likelihood ratio, capped at 1. The running minimum over looks is an always-valid p-value.
+    """
+    if not var > 0:
+        return 1.0
+    log_lr = 0.5 * np.log(var / (var + tau2)) + tau2 * diff**2 / (2 * var * (var + tau2))
+    return float(min(1.0, np.exp(-log_lr)))
+
+class GroupAccumulator:
+    """Sufficient statistics of one group, updated per micro-batch of events.
+
+    CR = purchasers / checkout users and ARPU = revenue / viewers are per-user metrics, so
+    distinct users are counted with HyperLogLog sketches. Revenue sum and sum of squares of
+    per-user revenue are exact: only purchasers are kept in revenue_by_user.
+    """
+    def __init__(self, precision=14):
+        self.viewers = HyperLogLog(precision)
+        self.checkout_users = HyperLogLog(precision)
+        self.purchase_users = HyperLogLog(precision)
+        self.revenue_by_user = {}
+        self.revenue_sum = 0.0
+        self.revenue_sumsq = 0.0
+
+    def update(self, events):
+        self.viewers.add(events.loc[events['event_type'] == 'view', 'user_id'].to_numpy())
+        self.checkout_users.add(events.loc[events['event_type'] == 'checkout', 'user_id'].to_numpy())
+        purchases = events[events['event_type'] == 'purchase']
+        self.purchase_users.add(purchases['user_id'].to_numpy())
+        for user_id, revenue in purchases.groupby('user_id')['revenue'].sum().items():
+            old = self.revenue_by_user.get(user_id, 0.0)
+            new = old + revenue
+            self.revenue_by_user[user_id] = new
+            self.revenue_sum += revenue
+            self.revenue_sumsq += new**2 - old**2
+
+    def cr_stats(self):
+        """Returns (n, mean, variance of the mean) of the purchase indicator among checkout users.
+        The sketch error of both distinct counts is added to the sampling variance.
+        """
+        n = self.checkout_users.count()
+        if n < 2:
+            return n, np.nan, np.nan
+        mean = min(1.0, self.purchase_users.count() / n)
+        sketch_var = 2 * (mean * self.checkout_users.relative_error)**2
+        return n, mean, mean * (1 - mean) / n + sketch_var
+
+    def arpu_stats(self):
+        """Returns (n, mean, variance of the mean) of per-user revenue among viewers.
+        Users without purchases count as 0, the sketch error of the viewer count is added to the sampling variance.
+        """
+        n = self.viewers.count()
+        if n < 2:
+            return n, np.nan, np.nan
+        mean = self.revenue_sum / n
+        var = (self.revenue_sumsq - n * mean**2) / (n - 1)
+        sketch_var = (mean * self.viewers.relative_error)**2
+        return n, mean, var / n + sketch_var
+
+class SequentialAccumulator:
+    """Streaming A/B monitor with always-valid (mSPRT) p-values for CR and ARPU.
+
+    Events outside of [start_date, end_date + 1 day] are ignored, so the same generator
+    or stream which feeds EventLogs can feed the accumulator. The state is small and can be
+    saved with save() between runs, no step rescans EventLogs.
+    The sketch error does not shrink with sample size, so effects below ~1% of the mean
+    are not detected on very large samples.
+    """
+    def __init__(self, start_date, end_date, groups=('A', 'B'), cr_tau=0.05, arpu_tau=0.1):
+        self.start_date = pd.Timestamp(start_date)
+        self.end_date = pd.Timestamp(end_date) + pd.Timedelta(days=1)
+        self.groups = {group: GroupAccumulator() for group in groups}
+        # mixture scale relative to the control mean, same as the MDEs in fix_sample_size
+        self.tau = {'CR': cr_tau, 'ARPU': arpu_tau}
+        self.p_values = {'CR': 1.0, 'ARPU': 1.0}
+        self.last_event_timestamp = None
+        self.num_events = 0
+
+    def update(self, events, test_groups):
+        """Adds a micro-batch of events.
+
+        Args:
+            events (pd.DataFrame): EventLogs rows with user_id, event_type, event_timestamp and revenue.
+            test_groups (pd.Series): test_group indexed by user_id.
+        """
+        timestamps = pd.to_datetime(events['event_timestamp'])
+        events = events[(timestamps >= self.start_date) & (timestamps <= self.end_date)]
+        if events.empty:
+            return
+        events = events.assign(test_group=events['user_id'].map(test_groups))
+        for group, df in events.groupby('test_group'):
+            if group in self.groups:
+                self.groups[group].update(df)
+        last_ts = pd.to_datetime(events['event_timestamp']).max()
+        self.last_event_timestamp = last_ts if self.last_event_timestamp is None else max(last_ts, self.last_event_timestamp)
+        self.num_events += len(events)
+
+    def results(self):
+        """Current estimates and always-valid p-values by metric.
+        Each call is a look, p-values are the running minimum over all looks.
+        """
+        control, variant = list(self.groups.values())[:2]
+        results = {}
+        for metric, stats in [('CR', GroupAccumulator.cr_stats), ('ARPU', GroupAccumulator.arpu_stats)]:
+            n_a, mean_a, var_a = stats(control)
+            n_b, mean_b, var_b = stats(variant)
+            if not (np.isnan(mean_a) or np.isnan(mean_b)):
+                tau2 = (self.tau[metric] * mean_a)**2
+                p_value = msprt_p_value(mean_b - mean_a, var_a + var_b, tau2)
+                self.p_values[metric] = min(self.p_values[metric], p_value)
+            results[metric] = {'control_value': mean_a, 'variant_value': mean_b,
+                               'p_value': self.p_values[metric],
+                               'sample_size_a': int(round(n_a)), 'sample_size_b': int(round(n_b))}
+        return results
+
+    def duration_days(self):
+        if self.last_event_timestamp is None:
+            return 0
+        return (self.last_event_timestamp - self.start_date).days + 1
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
@@ -0,0 +1,114 @@
+import os
+import re
+import statistics
+from functools import lru_cache
+from sqlalchemy import create_engine, event
+
+# Local SQLite stand-in for the MSSQL database: the schema of create_tables.sql and create_views.sql is
+# created from the same files, and T-SQL statements of the scripts are rewritten to SQLite before execution.
+# Table-valued functions of create_functions.sql are inlined as subqueries with their arguments.
+# MERGE becomes INSERT ... ON CONFLICT DO UPDATE, so its ON columns must be the primary key of the target.
+
+SQL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MERGE_RE = re.compile(r"MERGE\s+(?:INTO\s+)?(\w+)\s+AS\s+t\s+USING\s+(.*?)\s+AS\s+s\s+ON\s+.*?"
+                      r"\s+WHEN\s+MATCHED\s+THEN\s+UPDATE\s+SET\s+(.*?)"
+                      r"\s+WHEN\s+NOT\s+MATCHED\s+THEN\s+INSERT\s*\((.*?)\)\s*VALUES\s*\((.*)\)\s*;?\s*$", re.S | re.I)
+UPDATE_FROM_RE = re.compile(r"UPDATE\s+(\w+)\s+SET\s+(.*?)\s+FROM\s+(\w+)\s+AS\s+\1\s+JOIN\s+(.*?)\s+ON\s+(.*)$", re.S | re.I)
+
+# T-SQL -> SQLite rewrites applied after MERGE, UPDATE ... FROM and function calls
+REWRITES = [
+    (re.compile(r"\[EcommABtestDB\]\.\[dbo\]\.|\[dbo\]\.|\bdbo\.", re.I), ''),
+    (re.compile(r"\[(\w+)\]"), r'"\1"'),
+    (re.compile(r"\bGETDATE\(\)", re.I), 'CURRENT_TIMESTAMP'),
+    (re.compile(r"\bISNULL\(", re.I), 'IFNULL('),
+    (re.compile(r"\bCAST\(([^()]+?)\s+AS\s+DATE\)", re.I), r'date(\1)'),
+    (re.compile(r"\bDATEADD\(\s*day\s*,\s*(-?\d+)\s*,\s*([^()]+?)\s*\)", re.I), r"datetime(\2, '\1 days')"),
+    (re.compile(r"\bMONTH\(([^()]+)\)", re.I), r"CAST(strftime('%m', \1) AS INTEGER)"),
+    (re.compile(r"\bINT\s+IDENTITY\(1,\s*1\)\s+PRIMARY\s+KEY", re.I), 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+    (re.compile(r"\bVARBINARY\(MAX\)", re.I), 'BLOB'),
+    # DECIMAL has integer affinity in SQLite for whole values, SUM(revenue) / COUNT(...) would truncate
+    (re.compile(r"\bDECIMAL\(\d+,\s*\d+\)", re.I), 'REAL'),
+]
+
+def split_batches(sql):
+    """Statements of a T-SQL script separated by GO lines"""
+    return [batch.strip() for batch in re.split(r"^\s*GO\s*$", sql, flags=re.M) if batch.strip()]
+
+def read_functions(path=os.path.join(SQL_DIR, 'create_functions.sql'))->dict:
+    """Inline table-valued functions of the script: name -> (parameter names, body)"""
+    with open(path) as f:
+        batches = split_batches(f.read())
+    functions = {}
+    for batch in batches:
+        match = re.search(r"CREATE\s+FUNCTION\s+(?:dbo\.)?(\w+)\s*\((.*?)\)\s*RETURNS\s+TABLE\s+AS\s+RETURN\s*\((.*)\)\s*;?\s*$",
+                          batch, re.S | re.I)
+        if match:
+            functions[match.group(1)] = (re.findall(r"@(\w+)", match.group(2)), match.group(3))
+    return functions
+
+FUNCTIONS = read_functions()
+
+def _inline_functions(sql):
+    pattern = re.compile(r"(?:\[?dbo\]?\.)?\b(" + '|'.join(FUNCTIONS) + r")\s*\(([^()]*)\)", re.I)
+    def inline(match):
+        params, body = FUNCTIONS[match.group(1)]
+        args = [arg.strip() for arg in match.group(2).split(',')]
+        for param, arg in zip(params, args):
+            body = re.sub(rf"@{param}\b", arg, body)
+        return f"({_inline_functions(body)})"
+    return pattern.sub(inline, sql) if FUNCTIONS else sql
+
+@lru_cache(maxsize=256)
+def translate(sql)->str:
+    """SQLite version of a T-SQL statement"""
+    sql = _inline_functions(sql)
+    merge = MERGE_RE.search(sql)
+    if merge:
+        table, source, updates, columns, values = merge.groups()
+        updates = re.sub(r"\bs\.", 'excluded.', re.sub(r"\bt\.", '', updates))
+        sql = (f"INSERT INTO {table} ({columns}) SELECT {values} FROM {source} AS s WHERE true "
+               f"ON CONFLICT DO UPDATE SET {updates}")
+    update = UPDATE_FROM_RE.search(sql)
+    if update:
+        alias, updates, table, joined, condition = update.groups()
+        updates = re.sub(rf"\b{alias}\.(\w+)\s*=", r'\1 =', updates)
+        sql = f"UPDATE {table} AS {alias} SET {updates} FROM {joined} WHERE {condition}"
+    for pattern, replacement in REWRITES:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+class Variance:
+    """VAR aggregate: sample variance as in SQL Server"""
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self):
+        return statistics.variance(self.values) if len(self.values) > 1 else None
+
+def _on_connect(dbapi_connection, connection_record):
+    dbapi_connection.create_aggregate('VAR', 1, Variance)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    return translate(statement), parameters
+
+def create_standin_engine(path, **engine_options):
+    """SQLAlchemy engine over the SQLite file with T-SQL translation.
+    Parameters stay named, so the rewrites can reorder them.
+    """
+    engine = create_engine(f"sqlite:///{path}", paramstyle='named', **engine_options)
+    event.listen(engine, 'connect', _on_connect)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute, retval=True)
+    return engine
+
+def create_schema(engine, sql_dir=SQL_DIR):
+    """Creates the tables and views of create_tables.sql and create_views.sql"""
+    with engine.begin() as conn:
+        for script in ['create_tables.sql', 'create_views.sql']:
+            with open(os.path.join(sql_dir, script)) as f:
+                for statement in split_batches(f.read()):
+                    conn.exec_driver_sql(statement)
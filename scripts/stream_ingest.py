@@ -0,0 +1,265 @@
+import pandas as pd
+import numpy as np
+import asyncio
+import os
+import time
+from datetime import datetime
+from sqlalchemy import text
+import data_exchange
+import instrumentation
+import bulk_loader
+import generate_ecomm_data
+import metrics_cube
+import sequential_testing
+import collect_experiment_data
+
+# Streaming ingestion: a source coroutine puts micro-batches of events on a bounded asyncio queue and
+# one writer appends them to EventLogs. When the writer falls behind, the queue fills up and the source
+# waits on put(), so memory is bounded by QUEUE_SIZE batches (backpressure).
+# Every written batch updates the live metrics cube (and the sequential accumulator), DailyMetrics
+# is refreshed incrementally every REFRESH_SECONDS from the cube and the new days of EventLogs.
+
+EVENT_COLUMNS = ['user_id', 'event_type', 'event_timestamp', 'device', 'revenue']
+
+# Queue item which tells the writer that the source is exhausted
+_END = None
+
+class EventClock:
+    """Event time which runs speed times faster than the wall clock from start"""
+    def __init__(self, start, speed=1.0):
+        self.start = np.datetime64(pd.Timestamp(start).to_datetime64(), 'ms')
+        self.speed = speed
+        self.wall_start = time.monotonic()
+
+    def now(self):
+        return self.start + np.timedelta64(int((time.monotonic() - self.wall_start) * self.speed * 1000), 'ms')
+
+async def generated_events(queue, df_users, clock, rate, deadline, tick=0.5, seed=None):
+    """Live sessions of the experiment users: Poisson(rate * elapsed) sessions per tick with the funnel
+    of generate_session (vectorized by generate_events_block), group B gets the test-period uplift.
+    Funnel steps happen minutes after the view, they are held back until the event clock reaches them.
+    """
+    rng = np.random.default_rng(seed)
+    user_ids = df_users['user_id'].to_numpy()
+    test_groups = df_users['test_group'].to_numpy()
+    pending = pd.DataFrame(columns=EVENT_COLUMNS)
+    last_wall, last_ts = time.monotonic(), clock.now()
+    while time.monotonic() < deadline:
+        await asyncio.sleep(tick)
+        wall, now = time.monotonic(), clock.now()
+        # After a wait on a full queue at most 10 ticks are caught up
+        num_sessions = rng.poisson(rate * min(wall - last_wall, 10 * tick))
+        users = rng.integers(0, len(user_ids), size=num_sessions)
+        start, end = pd.Timestamp(last_ts).to_pydatetime(), pd.Timestamp(now).to_pydatetime()
+        sessions = generate_ecomm_data.generate_events_block(rng, user_ids[users], test_groups[users],
+                                                             start, end, start, end, 0, 1)
+        pending = pd.concat([pending, sessions], ignore_index=True) if len(pending) else sessions
+        is_due = pending['event_timestamp'].to_numpy() <= now
+        if is_due.any():
+            await queue.put((wall, pending[is_due].reset_index(drop=True)))
+            pending = pending[~is_due]
+        last_wall, last_ts = wall, now
+
+def _replay_chunks(engine, table, start_date, end_date, chunksize):
+    with engine.connect() as conn:
+        yield from pd.read_sql(text(f"""
+            SELECT user_id, event_type, event_timestamp, device, revenue
+            FROM {table}
+            WHERE event_timestamp >= :start_date AND event_timestamp < :end_date
+            ORDER BY event_timestamp
+        """), con=conn, params={'start_date': start_date, 'end_date': end_date}, chunksize=chunksize)
+
+async def replayed_events(queue, engine, table, clock, start_date, end_date, deadline, tick=0.5, chunksize=100_000):
+    """Events of [start_date, end_date) of the table in timestamp order, emitted every tick when the event clock
+    reaches them. Chunks are read in a worker thread, speed 0 replays them as fast as the writer accepts them.
+    """
+    chunks = _replay_chunks(engine, table, start_date, end_date, chunksize)
+    while time.monotonic() < deadline:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            return
+        chunk['event_timestamp'] = pd.to_datetime(chunk['event_timestamp'])
+        while len(chunk) and time.monotonic() < deadline:
+            num_due = np.searchsorted(chunk['event_timestamp'].to_numpy(), clock.now(), side='right') if clock.speed > 0 else len(chunk)
+            if num_due:
+                await queue.put((time.monotonic(), chunk.iloc[:num_due].reset_index(drop=True)))
+                chunk = chunk.iloc[num_due:]
+            if len(chunk):
+                await asyncio.sleep(tick)
+
+class LiveSink:
+    """Writes micro-batches to the events table and keeps the live aggregates of the experiment"""
+    def __init__(self, engine, config, experiment_id, table, test_groups, cube, load_method=None):
+        self.engine = engine
+        self.config = config
+        self.experiment_id = experiment_id
+        self.table = table
+        self.test_groups = test_groups
+        self.cube = cube
+        self.loader = bulk_loader.LOADERS[load_method or bulk_loader.default_method(engine)]
+        self.accumulator = None
+        if config.getboolean('SEQUENTIAL', 'ENABLED', fallback=False):
+            state_path = config.get('SEQUENTIAL', 'STATE_PATH', fallback='.//data//sequential_state.pkl')
+            if os.path.exists(state_path):
+                self.accumulator = sequential_testing.SequentialAccumulator.load(state_path)
+            else:
+                self.accumulator = sequential_testing.SequentialAccumulator(
+                    datetime.strptime(config['DATA']['TEST_START_DATE'], "%d-%m-%Y"),
+                    datetime.strptime(config['DATA']['TEST_END_DATE'], "%d-%m-%Y"))
+        self.store = None
+        self.store_buffer = []
+        if data_exchange.use_event_store(config):
+            import event_store
+            self.store = event_store.EventStore(data_exchange.event_store_dir(config))
+
+    def write(self, df):
+        self.loader(self.engine, self.table, df[EVENT_COLUMNS])
+        self.cube.update(df, self.test_groups)
+        if self.accumulator is not None:
+            self.accumulator.update(df, self.test_groups)
+        if self.store is not None:
+            self.store_buffer.append(df)
+
+    def refresh(self):
+        """Publishes the live aggregates: DailyMetrics (when the stream goes to EventLogs), cube and sequential state.
+        Store appends are batched here too, every append writes one part per event date.
+        """
+        if self.table == 'EventLogs':
+            collect_experiment_data.populate_daily_metrics(self.engine, self.experiment_id, self.cube, incremental=True)
+        self.cube.save(self.config.get('CUBE', 'PATH', fallback=f'.//data//cube_{self.experiment_id}.npz'))
+        if self.accumulator is not None:
+            self.accumulator.save(self.config.get('SEQUENTIAL', 'STATE_PATH', fallback='.//data//sequential_state.pkl'))
+        if self.store_buffer:
+            self.store.append(pd.concat(self.store_buffer, ignore_index=True)[EVENT_COLUMNS])
+            self.store_buffer = []
+
+    def summary(self, day):
+        """Live unique users, conversion rate and ARPU of the day by group"""
+        df = self.cube.basic_stat_by_group(day, day)
+        return ', '.join(f"{row.test_group}: {row.view_count} viewers, CR {row.conversion_rate:.3f}, ARPU {row.arpu:.2f}"
+                         for row in df.itertuples())
+
+async def write_batches(queue, sink, stats, batch_rows=10_000, flush_seconds=1.0, refresh_seconds=30.0):
+    """Collects queue items into batches of batch_rows (or whatever arrived within flush_seconds) and writes them.
+    Writes and refreshes run in a worker thread, the source keeps producing while they run.
+    """
+    loop = asyncio.get_running_loop()
+    buffer, oldest, last_refresh = [], None, loop.time()
+    done = False
+    while not done:
+        timeout = None if oldest is None else max(0.0, oldest + flush_seconds - loop.time())
+        try:
+            item = await asyncio.wait_for(queue.get(), timeout)
+        except TimeoutError:
+            item = ()
+        if item is _END:
+            done = True
+        elif item:
+            produced_at, df = item
+            buffer.append((produced_at, df))
+            oldest = loop.time() if oldest is None else oldest
+            stats['max_queue'] = max(stats['max_queue'], queue.qsize())
+        if buffer and (done or sum(len(df) for _, df in buffer) >= batch_rows or loop.time() - oldest >= flush_seconds):
+            df = pd.concat([df for _, df in buffer], ignore_index=True)
+            await asyncio.to_thread(sink.write, df)
+            stats['rows'] += len(df)
+            stats['batches'] += 1
+            stats['max_latency'] = max(stats['max_latency'], time.monotonic() - min(t for t, _ in buffer))
+            stats['last_event_timestamp'] = df['event_timestamp'].max()
+            buffer, oldest = [], None
+        if done or loop.time() - last_refresh >= refresh_seconds:
+            await asyncio.to_thread(sink.refresh)
+            last_refresh = loop.time()
+            elapsed = time.monotonic() - stats['start']
+            day = stats['last_event_timestamp']
+            print(f"[stream] {stats['rows']} events in {elapsed:.0f}s ({stats['rows'] / elapsed:.0f}/s), "
+                  f"{stats['batches']} batches, max queued batches {stats['max_queue']}, max ingest latency {stats['max_latency']:.2f}s")
+            if day is not None:
+                print(f"[stream] {pd.Timestamp(day).date()} live: {sink.summary(day)}")
+
+async def stream(source, sink, queue_size=8, **batch_options):
+    """Runs the source coroutine factory source(queue) and the writer until the source is exhausted.
+    On Ctrl+C the source stops and the queued events are still written.
+    """
+    queue = asyncio.Queue(maxsize=queue_size)
+    stats = {'start': time.monotonic(), 'rows': 0, 'batches': 0, 'max_queue': 0, 'max_latency': 0.0,
+             'last_event_timestamp': None}
+    writer = asyncio.create_task(write_batches(queue, sink, stats, **batch_options))
+    try:
+        await source(queue)
+    except asyncio.CancelledError:
+        print("[stream] Interrupted, writing the queued events.")
+    await queue.put(_END)
+    await writer
+    stats['seconds'] = time.monotonic() - stats['start']
+    stats['rows_per_sec'] = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else np.nan
+    return stats
+
+def run(config, engine, experiment_id=None):
+    """Streams events of the experiment (the latest one if None) from the STREAM.SOURCE into STREAM.TABLE.
+
+    SOURCE = generate: live sessions of the experiment users at RATE sessions per second.
+    SOURCE = replay: events of [START, END) of REPLAY_TABLE in timestamp order at SPEED times real time
+    (SPEED = 0 for as fast as possible), REPLAY_TABLE must differ from TABLE.
+    The generate clock starts at START, by default at the last event of the experiment (DATA.TEST_START_DATE
+    if it has none): DailyMetrics refreshes are incremental from the high-water mark of event_timestamp,
+    streamed events before it are in EventLogs but not in DailyMetrics until a full collect.
+    Returns: dict with rows, batches, seconds, rows_per_sec, max_queue and max_latency.
+    """
+    section = config['STREAM'] if config.has_section('STREAM') else {}
+    batch_rows = int(section.get('BATCH_ROWS', '10000'))
+    source_name = section.get('SOURCE', 'generate')
+    table = section.get('TABLE', 'EventLogs')
+    speed = float(section.get('SPEED', '1'))
+    start_date = datetime.strptime(section.get('START', config['DATA']['TEST_START_DATE']), "%d-%m-%Y")
+    end_date = datetime.strptime(section.get('END', config['DATA']['TEST_END_DATE']), "%d-%m-%Y") + pd.Timedelta(days=1)
+    duration = float(section.get('DURATION_SECONDS', '60'))
+    deadline = time.monotonic() + duration if duration > 0 else float('inf')
+    tick = float(section.get('TICK_SECONDS', '0.5'))
+
+    if experiment_id is None:
+        sql_str_for_experiment_id = "SELECT MAX([experiment_id]) FROM [EcommABtestDB].[dbo].[Experiments]"
+        experiment_id = int(pd.read_sql(sql_str_for_experiment_id, con=engine).iloc[0,0])
+    df_users = pd.read_sql(text("SELECT user_id, test_group FROM UserAssignments WHERE experiment_id = :experiment_id"),
+                           con=engine, params={'experiment_id': experiment_id})
+    test_groups = df_users.set_index('user_id')['test_group']
+
+    if table == 'EventLogs':
+        # DailyMetrics refreshes take the daily user sketches from the cube, so it starts from all events
+        cube = collect_experiment_data.build_metrics_cube(engine, config, experiment_id)
+    else:
+        cube = metrics_cube.MetricsCube(experiment_id)
+    sink = LiveSink(engine, config, experiment_id, table, test_groups, cube, config['DATA'].get('LOAD_METHOD'))
+
+    if source_name == 'generate' and 'START' not in section:
+        with engine.connect() as conn:
+            _, last_ts = collect_experiment_data.get_max_event_timestamp(conn, experiment_id)
+        start_date = start_date if last_ts is None else max(start_date, pd.Timestamp(last_ts).to_pydatetime())
+    clock = EventClock(start_date, speed)
+    if source_name == 'generate':
+        if duration <= 0:
+            raise ValueError("STREAM.DURATION_SECONDS must be positive for the generate source")
+        rate = float(section.get('RATE', '100'))
+        source = lambda queue: generated_events(queue, df_users, clock, rate, deadline, tick,
+                                                int(config['DATA'].get('SEED', 42)))
+    elif source_name == 'replay':
+        replay_table = section.get('REPLAY_TABLE', 'EventLogs')
+        if replay_table == table:
+            raise ValueError(f"Replaying {replay_table} into itself would duplicate its events, set STREAM.TABLE")
+        source = lambda queue: replayed_events(queue, engine, replay_table, clock, start_date, end_date, deadline, tick,
+                                               batch_rows)
+    else:
+        raise ValueError(f"Unknown STREAM.SOURCE {source_name!r}, expected generate or replay")
+
+    print(f"Streaming {source_name} events of experiment {experiment_id} into {table} from {start_date:%Y-%m-%d} at {speed:g}x")
+    stats = asyncio.run(stream(source, sink, int(section.get('QUEUE_SIZE', '8')),
+                               batch_rows=batch_rows,
+                               flush_seconds=float(section.get('FLUSH_SECONDS', '1')),
+                               refresh_seconds=float(section.get('REFRESH_SECONDS', '30'))))
+    print(f"Streamed {stats['rows']} events in {stats['seconds']:.1f}s ({stats['rows_per_sec']:.0f} events/sec).")
+    return stats
+
+if __name__ == "__main__":
+    config, engine = data_exchange.connect_to_db()
+    with instrumentation.span('stream'):
+        run(config, engine)
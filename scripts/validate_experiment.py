@@ -10,18 +10,17 @@ import matplotlib.pyplot as plt
 import scipy as sp
 import local_statistics as local_stat
 import data_exchange
+import instrumentation
 
 
-if __name__ == "__main__":
-    
-    config, engine = data_exchange.connect_to_db()
+def run(config, engine):
+    """A/A tests and SRM check on the history period"""
         
     # A/A test for CR = Unique number of users with purchase / Unique number of users with checkout
     start_date = datetime.strptime(config['DATA']['HISTORY_START_DATE'], "%d-%m-%Y").strftime("%Y-%m-%d")
     end_date = datetime.strptime(config['DATA']['HISTORY_END_DATE'], "%d-%m-%Y").strftime("%Y-%m-%d")
     
-    sql_str = f"SELECT * FROM dbo.GetBasicStatByGroup('{start_date}', '{end_date}')"
-    group_cr = pd.read_sql(sql_str, con=engine)
+    group_cr = data_exchange.get_basic_stat_by_group(engine, config, start_date, end_date)
     group_cr = group_cr.set_index('test_group')
     
     p_value = local_stat.proportions_z_test(
@@ -35,11 +34,11 @@ if __name__ == "__main__":
         print(f"\nA/A test for CR doesn't pass! Re-sample data! \nNull-hypothesis can be rejected as P-value for CR test {p_value:.4}. \nSamples A and B on history data represent significantly difference.")
     
     # A/A test for revenue
-    sql_str = f"SELECT * FROM dbo.GetTotalRevenueByUser('{start_date}', '{end_date}')"
-    group_revenue = pd.read_sql(sql_str, con=engine)
-    group_a_values = group_revenue[group_revenue['test_group'] == 'A']['revenue_sum']
-    group_b_values = group_revenue[group_revenue['test_group'] == 'B']['revenue_sum']
-    u_stat, p_value = sp.stats.mannwhitneyu(group_a_values, group_b_values, alternative='two-sided')
+    revenue_hist = data_exchange.get_revenue_histogram_by_group(engine, config, start_date, end_date)
+    hist_a = revenue_hist[revenue_hist['test_group'] == 'A']
+    hist_b = revenue_hist[revenue_hist['test_group'] == 'B']
+    u_stat, p_value = local_stat.mannwhitneyu_compressed(hist_a['revenue_sum'], hist_a['num_users'],
+                                                         hist_b['revenue_sum'], hist_b['num_users'], alternative='two-sided')
     if p_value > float(config['EXPERIMENT']['ALPHA']):
         print(f"\nA/A test for revenue passed. \nCan't reject null-hypothesis as P-value for ARPU test {p_value:.2}. \nSamples A and B on history data do not represent significantly difference.")
     else:
@@ -51,3 +50,8 @@ if __name__ == "__main__":
         print(f"\nNo SRM Detected. \nP-value for Chi-Square Goodness of Fit is {srm_p_value:.2}")
     else:
         print(f"\nSRM Detected! Check for bugs.\n P-value for Chi-Square Goodness of Fit is {srm_p_value:.2}")
+
+if __name__ == "__main__":
+    config, engine = data_exchange.connect_to_db()
+    with instrumentation.span('validate'):
+        run(config, engine)